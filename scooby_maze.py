@@ -24,15 +24,157 @@
 import pygame
 from pygame.locals import *
 import threading
+import multiprocessing
+import concurrent.futures
+import itertools
+import bisect
+import collections
+import array
+import mmap
+import struct
+import json
 import os
 import sys
 import random
 import time
+import platform
 
 FRAMES_PER_SECOND = 60
+#The game logic always runs at this rate, whatever the frame rate, and
+#every speed is in pixels per tick.  A frame that falls further behind
+#than MAX_TICKS_PER_FRAME ticks lets the game slow down instead.
+TICKS_PER_SECOND = 60
+MAX_TICKS_PER_FRAME = 6
+#The frame clock only counts whole milliseconds, so a frame this close
+#to a whole number of ticks counts as exactly that many
+TICK_SNAP = 0.001
+#Ghosts within GHOST_NEAR_CELLS cells of Shaggy (along the maze) move
+#every tick, ghosts within GHOST_FAR_CELLS every GHOST_TIER_TICKS ticks
+#and the rest sleep until he comes closer
+GHOST_NEAR_CELLS = 6
+GHOST_FAR_CELLS = 18
+GHOST_TIER_TICKS = 4
+#In a streamed maze a door only leads to doors within this many rows
+DOOR_SEARCH_ROWS = 32
+#Levels with up to this many cells are laid out in the game process,
+#quicker than handing them to the level worker and back
+LOCAL_LAYOUT_CELLS = 1024
+
+ASSET_PACK = os.path.join("data","assets.pak")
+
+class AssetPack:
+	#A single file holding every image already converted to the display's
+	#pixel format.  The file is memory mapped and surfaces are built
+	#straight on top of it, so nothing is read until an image is used.
+	MAGIC = b"SMPACK1\n"
+	ALIGN = 64
+	def __init__(self):
+		self.buffer = None
+		self.format = None
+		self.data_start = 0
+		self.images = {}
+
+	def Open(self,filename=ASSET_PACK):
+		#Silently stays empty if there is no pack or it was built for a
+		#different pixel format, leaving load_image to use the bitmaps
+		self.images = {}
+		try:
+			f = open(filename,"rb")
+		except OSError:
+			return False
+		with f:
+			try:
+				buffer = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_COPY)
+			except (OSError,ValueError):
+				return False
+		header_size = len(self.MAGIC)+4
+		if buffer[:len(self.MAGIC)] != self.MAGIC:
+			return False
+		index_size = struct.unpack("<I",buffer[len(self.MAGIC):header_size])[0]
+		index = json.loads(buffer[header_size:header_size+index_size].decode())
+		surface = pygame.display.get_surface()
+		if surface == None or index["bitsize"] != surface.get_bitsize() or \
+			index["masks"] != list(surface.get_masks()[:3]):
+			return False
+		#The pixel data starts at the first aligned offset after the index
+		self.data_start = header_size+index_size
+		self.data_start = self.data_start+(-self.data_start%self.ALIGN)
+		self.buffer = buffer
+		self.format = index["format"]
+		self.images = index["images"]
+		return True
+
+	def GetImage(self,filename,bColorkey=True):
+		#Returns None if the image is not in the pack or its bitmap has
+		#changed since the pack was built
+		entry = self.images.get(filename)
+		if entry == None:
+			return None
+		try:
+			stat = os.stat(os.path.join("data",filename))
+		except OSError:
+			pass
+		else:
+			if [stat.st_size,int(stat.st_mtime)] != entry["source"]:
+				return None
+		offset = self.data_start+entry["offset"]
+		pixels = memoryview(self.buffer)[offset:offset+entry["length"]]
+		image = pygame.image.frombuffer(pixels,entry["size"],self.format)
+		if image.get_flags() & SRCALPHA:
+			#pygame has no name for a padded BGR layout, so it comes back
+			#with an alpha channel that has to be converted away
+			image = image.convert()
+		if bColorkey and entry["colorkey"] != None:
+			image.set_colorkey(entry["colorkey"],RLEACCEL)
+		return image
+
+	def Save(self,filename=ASSET_PACK):
+		#Pack every bitmap in data/ for the current display
+		surface = pygame.display.get_surface()
+		masks = list(surface.get_masks()[:3])
+		if surface.get_bitsize() == 32 and masks == [0xff0000,0xff00,0xff]:
+			format = "BGRA"
+		elif surface.get_bitsize() == 32 and masks == [0xff,0xff00,0xff0000]:
+			format = "RGBX"
+		else:
+			raise SystemExit("Asset packs do not support this display's pixel format")
+		images = {}
+		blobs = []
+		offset = 0
+		for name in sorted(os.listdir("data")):
+			if not name.endswith(".bmp"):
+				continue
+			full_filename = os.path.join("data",name)
+			stat = os.stat(full_filename)
+			image = pygame.image.load(full_filename).convert()
+			blob = pygame.image.tobytes(image,format)
+			images[name] = { "size"     : list(image.get_size()),
+							 "offset"   : offset,
+							 "length"   : len(blob),
+							 "colorkey" : 0xff0000,
+							 "source"   : [stat.st_size,int(stat.st_mtime)] }
+			blob = blob + bytes(-len(blob)%self.ALIGN)
+			blobs.append(blob)
+			offset = offset + len(blob)
+		index = { "bitsize" : 32,
+				  "masks"   : masks,
+				  "format"  : format,
+				  "images"  : images }
+		text = json.dumps(index).encode()
+		header = self.MAGIC+struct.pack("<I",len(text))+text
+		with open(filename,"wb") as f:
+			f.write(header)
+			f.write(bytes(-len(header)%self.ALIGN))
+			for blob in blobs:
+				f.write(blob)
+		return len(images)
+
+asset_pack = AssetPack()
 
 def load_image(filename,bColorkey=True):
-	image = None
+	image = asset_pack.GetImage(filename,bColorkey)
+	if image != None:
+		return image
 	full_filename = os.path.join("data",filename)
 	try:
 		image = pygame.image.load(full_filename)
@@ -177,7 +319,6 @@ class MazeObject(pygame.sprite.Sprite):
 				width, height = self.image.get_size()
 				self.maze_rect = pygame.Rect(0,0,width,height)
 				self.rect	  = pygame.Rect(0,0,width,height)
-				self.tmp_rect  = pygame.Rect(0,0,0,0)
 		else:
 			self.style     = demo.style
 			self.images    = demo.images
@@ -185,7 +326,6 @@ class MazeObject(pygame.sprite.Sprite):
 			self.direction = demo.direction
 			self.maze_rect = pygame.Rect(demo.maze_rect)
 			self.rect      = pygame.Rect(demo.rect)
-			self.tmp_rect  = pygame.Rect(0,0,0,0)
 
 	def GetMaxSize(self):
 		max_width = 0
@@ -206,57 +346,38 @@ class MazeObject(pygame.sprite.Sprite):
 		
 	def Move(self,maze,x_offset,y_offset):
 		if not(x_offset == 0 and y_offset == 0):
-			if y_offset > 0:
-				self.direction = self.D_DOWN
-			elif y_offset < 0:
-				self.direction = self.D_UP
-			if x_offset > 0:
-				self.direction = self.D_RIGHT
-			elif x_offset < 0:
-				self.direction = self.D_LEFT
-				
-			if not self.style & self.CONST:
-				if self.direction == self.D_DOWN and self.style & self.FRONT:
-					self.image = self.images[self.FRONT]
-				elif self.direction == self.D_UP and self.style & self.BACK:
-					self.image = self.images[self.BACK]
-				
-				if self.direction == self.D_RIGHT and self.style & self.RIGHT:
-					self.image = self.images[self.RIGHT]
-				elif self.direction == self.D_LEFT and self.style & self.LEFT:
-					self.image = self.images[self.LEFT]
-				
-				self.rect.size	  = self.image.get_size()
-				self.maze_rect.size = self.image.get_size()
+			self.Face(x_offset,y_offset)
+			maze_rect = self.maze_rect
+			maze_rect.left = maze_rect.left + maze.GetFreeDistance(maze_rect,x_offset)
+			maze_rect.top  = maze_rect.top + maze.GetFreeDistance(maze_rect,y_offset,True)
+
+	def Face(self,x_offset,y_offset):
+		#Turn toward the given movement and pick the matching image
+		if y_offset > 0:
+			self.direction = self.D_DOWN
+		elif y_offset < 0:
+			self.direction = self.D_UP
+		if x_offset > 0:
+			self.direction = self.D_RIGHT
+		elif x_offset < 0:
+			self.direction = self.D_LEFT
 			
-			new_rect = self.tmp_rect
-			new_rect.size = self.maze_rect.size
+		if not self.style & self.CONST:
+			image = self.image
+			if self.direction == self.D_DOWN and self.style & self.FRONT:
+				image = self.images[self.FRONT]
+			elif self.direction == self.D_UP and self.style & self.BACK:
+				image = self.images[self.BACK]
 			
-			final_x_offset = 0
-			for i in range(abs(x_offset)):
-				i = i+1
-				if x_offset < 0:
-					i = 0 - i
-				new_rect.topleft = (self.maze_rect.left + i,
-									self.maze_rect.top)
-				if maze.Collide(new_rect):
-					break
-				else:
-					final_x_offset = i
-			self.maze_rect.left = self.maze_rect.left + final_x_offset
-	
-			final_y_offset = 0
-			for i in range(abs(y_offset)):
-				i = i+1
-				if y_offset < 0:
-					i = 0 - i
-				new_rect.topleft = ( self.maze_rect.left,
-									 self.maze_rect.top + i)
-				if maze.Collide(new_rect):
-					break
-				else:
-					final_y_offset = i
-			self.maze_rect.top = self.maze_rect.top + final_y_offset
+			if self.direction == self.D_RIGHT and self.style & self.RIGHT:
+				image = self.images[self.RIGHT]
+			elif self.direction == self.D_LEFT and self.style & self.LEFT:
+				image = self.images[self.LEFT]
+
+			if image is not self.image:
+				self.image = image
+				self.rect.size	  = image.get_size()
+				self.maze_rect.size = image.get_size()
 				
 	def SetPosition(self,x,y):
 		self.maze_rect.left = x
@@ -289,40 +410,70 @@ class MazeObject(pygame.sprite.Sprite):
 		self.Move(maze,x_offset,y_offset)
 		
 class Maze:
-	NORTH   = 0
-	SOUTH   = 1
-	EAST	= 2
-	WEST	= 3
-	VISITED = 4
+	#Each cell is one byte in a row major bytearray.  The low four bits
+	#are set when the passage in that direction is open.
+	NORTH   = 0x01
+	SOUTH   = 0x02
+	EAST	= 0x04
+	WEST	= 0x08
+	VISITED = 0x10
+	OPEN	= 0x0f
+
+	#Translation table that maps a cell byte to 1 if it is a dead end
+	#(visited with exactly one open passage) and to 0 otherwise.
+	DEAD_END_TABLE = bytes( [ 1 if (v & 0x10) and
+								   bin(v & 0x0f).count("1") == 1 else 0
+							  for v in range(256) ] )
+
+	#Size in pixels of the square tiles the walls are pre-rendered into,
+	#and how many of them are kept around before the least recently
+	#used one is thrown away.
+	TILE_SIZE = 256
+	MAX_TILES = 32
+
+	#Every order in which the generator can try a cell's neighbors
+	DIRECTION_ORDERS = list(itertools.permutations( (NORTH,SOUTH,EAST,WEST) ))
+
+	#Maze files: a header with the dimensions, cell geometry, whether
+	#there is a seed and the seed, followed by the four passage bits of
+	#each cell packed two cells to a byte, the even cell in the low
+	#nibble.  Every cell of a generated maze is visited, so unpacking
+	#puts VISITED back.  Version 1 files have no seed flag and a seed of
+	#-1 for none; they can still be loaded.
+	FILE_MAGIC     = b"SMMAZE2\n"
+	FILE_HEADER    = struct.Struct("<8sIIIIIBq")
+	FILE_MAGIC_V1  = b"SMMAZE1\n"
+	FILE_HEADER_V1 = struct.Struct("<8sIIIIIq")
+	PACK_LOW    = bytes( [ v & 0x0f for v in range(256) ] )
+	PACK_HIGH   = bytes( [ (v & 0x0f) << 4 for v in range(256) ] )
+	UNPACK_LOW  = bytes( [ (v & 0x0f) | 0x10 for v in range(256) ] )
+	UNPACK_HIGH = bytes( [ (v >> 4) | 0x10 for v in range(256) ] )
+
+	#Mazes with more cells than this are streamed: their cells are a
+	#MazeRows, made as they are needed instead of all up front
+	STREAM_CELLS = 1 << 20
 	
 	def __init__(self,num_cols,num_rows,
-				 cell_width,cell_height,wall_width):
-		#Generate the maze structures
+				 cell_width,cell_height,wall_width,cells=None,seed=None):
+		#Generate the maze structures, unless the cells of an already
+		#generated maze (or a MazeRows) are passed in.  The same seed
+		#always generates the same maze.
 		self.num_rows = num_rows
 		self.num_cols = num_cols
-
-		self.cells = []
-		for r in range(num_rows):
-			row = []
-			for c in range(num_cols):
-				row.append( [False,False,False,False,False] )
-			self.cells.append(row)
-		
-		self.start_cells = [ (int(num_rows/2),int(num_cols/2)) ]
-		while len(self.start_cells) > 0:
-			row, col = self.start_cells[0]
-			del self.start_cells[0] 
-			self._discover(row, col)
+		self.seed = seed
+
+		if cells == None:
+			cells = self.GenerateCells(num_cols,num_rows,seed)
+		if isinstance(cells,MazeRows):
+			#Dead ends are looked up a row at a time instead
+			self.cells = cells
+			self.dead_ends = None
+		else:
+			self.cells = bytearray(cells)
+			self.dead_ends = self.cells.translate(self.DEAD_END_TABLE)
 			
-		#Generate rectangles used to detect collisions
-		#and surface used for painting
-		self.rects = []
-		for c in range(num_cols):
-			col = []
-			for r in range(num_rows):
-				col.append([])
-			self.rects.append(col)
-
+		#Walls are not stored; collisions and drawing work them out from
+		#the cell bits and this geometry when needed
 		self.cell_width  = cell_width
 		self.cell_height = cell_height
 		self.wall_width  = wall_width
@@ -333,95 +484,112 @@ class Maze:
 		height = self.total_cell_height*num_rows
 		self.maze_rect = pygame.Rect(0,0,width,height)
 
-		for r in range(num_rows):
-			for c in range(num_cols):
-				cell = self.cells[r][c]
-
-				if r == 0:
-					if not cell[self.NORTH]:
-						rect = (c*self.total_cell_width,
-								r*self.total_cell_height,
-								self.total_cell_width,
-								wall_width)
-						self.rects[c][r].append(rect)
-				if c == num_cols-1:
-					if not cell[self.EAST]:
-						rect = ((c+1)*self.total_cell_width - wall_width,
-								r*self.total_cell_height,
-								wall_width,
-								self.total_cell_height)
-						self.rects[c][r].append(rect)
-				if not cell[self.SOUTH]:
-					if c == num_cols - 1:
-						rect = (c*self.total_cell_width,
-								(r+1)*self.total_cell_height - wall_width,
-								self.total_cell_width,
-								wall_width)
-						self.rects[c][r].append(rect)
-					else:
-						rect = (c*self.total_cell_width,
-								(r+1)*self.total_cell_height-wall_width,
-								self.total_cell_width+wall_width,
-								wall_width)
-						self.rects[c][r].append(rect)
-				if not cell[self.WEST]:
-					rect = (c*self.total_cell_width,
-							r*self.total_cell_height,
-							wall_width,
-							self.total_cell_height) 
-					self.rects[c][r].append(rect)
-			
-	def _discover( self, current_row , current_col ):
-		self.cells[current_row][current_col][self.VISITED] = True
-		
-		directions = []
-		for j in range(4):
-			rand_dir = random.randint(self.NORTH,self.WEST)
-			for i in range(4):
-				dir = rand_dir - i
-				if dir < 0:
-					dir = 4 + dir
-				if dir not in directions:
-					directions.append(dir)
-					break
-
-		for direction in directions:
-			if direction == self.NORTH and current_row > 0:
-				if not self.cells[current_row-1][current_col][self.VISITED]:
-					self.cells[current_row][current_col][self.NORTH] = True
-					self.cells[current_row-1][current_col][self.SOUTH] = True
-					try:
-						self._discover(current_row-1,current_col)
-					except RuntimeError as why:
-						self.start_cells.append( (current_row-1,current_col) )
-					continue
-			elif direction == self.SOUTH and current_row < self.num_rows-1:
-				if not self.cells[current_row+1][current_col][self.VISITED]:
-					self.cells[current_row][current_col][self.SOUTH] = True
-					self.cells[current_row+1][current_col][self.NORTH] = True
-					try:
-						self._discover(current_row+1,current_col)
-					except RuntimeError as why:
-						self.start_cells.append( (current_row+1,current_col) )
-					continue
-			elif direction == self.EAST and current_col < self.num_cols-1:
-				if not self.cells[current_row][current_col+1][self.VISITED]:
-					self.cells[current_row][current_col][self.EAST] = True
-					self.cells[current_row][current_col+1][self.WEST] = True
-					try:
-						self._discover(current_row,current_col+1)
-					except RuntimeError as why:
-						self.start_cells.append( (current_row,current_col+1) )
-					continue
-			elif direction == self.WEST and current_col > 0:
-				if not self.cells[current_row][current_col-1][self.VISITED]:
-					self.cells[current_row][current_col][self.WEST] = True
-					self.cells[current_row][current_col-1][self.EAST] = True
-					try:
-						self._discover(current_row,current_col-1)
-					except RuntimeError as why:
-						self.start_cells.append( (current_row,current_col-1) )
+		self.tiles = collections.OrderedDict()
+		self.tile_color = None
+
+	@staticmethod
+	def GenerateCells(num_cols,num_rows,seed=None):
+		#Randomized depth first search from the middle of the maze, driven
+		#by an explicit stack so the Python stack depth stays constant no
+		#matter the maze size.  Each stack entry holds a cell index and an
+		#iterator over the directions still left to try from it.  Only
+		#the cells are built, so this is safe to run in a worker process.
+		cells = bytearray(num_rows*num_cols)
+		orders = Maze.DIRECTION_ORDERS
+		num_orders = len(orders)
+		if seed == None:
+			rand = random.random
+		else:
+			rand = random.Random(seed).random
+		NORTH, SOUTH, EAST, WEST = Maze.NORTH, Maze.SOUTH, Maze.EAST, Maze.WEST
+		VISITED = Maze.VISITED
+		start = int(num_rows/2)*num_cols+int(num_cols/2)
+		cells[start] = cells[start] | VISITED
+		stack = [ (start,iter(orders[int(rand()*num_orders)])) ]
+		while len(stack) > 0:
+			current, directions = stack[-1]
+			current_row, current_col = divmod(current,num_cols)
+			for direction in directions:
+				if direction == NORTH:
+					if current_row == 0:
+						continue
+					index, opposite = current-num_cols, SOUTH
+				elif direction == SOUTH:
+					if current_row == num_rows-1:
+						continue
+					index, opposite = current+num_cols, NORTH
+				elif direction == EAST:
+					if current_col == num_cols-1:
+						continue
+					index, opposite = current+1, WEST
+				else:
+					if current_col == 0:
+						continue
+					index, opposite = current-1, EAST
+				if cells[index] & VISITED:
 					continue
+				cells[current] = cells[current] | direction
+				cells[index] = cells[index] | opposite | VISITED
+				stack.append( (index,iter(orders[int(rand()*num_orders)])) )
+				break
+			else:
+				stack.pop()
+		return cells
+
+	def Save(self,filename):
+		#The header only holds integer seeds that fit in 64 bits, any
+		#other seed is saved as none since the cells are saved anyway
+		seed = self.seed
+		bHasSeed = isinstance(seed,int) and seed >= -(1 << 63) and seed < (1 << 63)
+		if not bHasSeed:
+			seed = 0
+		cells = self.cells
+		if self.dead_ends == None:
+			cells = cells.GetRows(0,self.num_rows)
+		#The low and high nibbles never overlap, so the two halves can be
+		#merged with a single big integer OR instead of a Python loop
+		low = cells[0::2].translate(self.PACK_LOW)
+		high = cells[1::2].translate(self.PACK_HIGH)
+		packed = int.from_bytes(low,"little") | int.from_bytes(high,"little")
+		with open(filename,"wb") as f:
+			f.write(self.FILE_HEADER.pack(self.FILE_MAGIC,self.num_cols,self.num_rows,
+										  self.cell_width,self.cell_height,
+										  self.wall_width,bHasSeed,seed))
+			f.write(packed.to_bytes(len(low),"little"))
+
+	@staticmethod
+	def Load(filename):
+		#Build a maze straight from a saved file without generating it.
+		#The packed cells are read once and unpacked from there.
+		with open(filename,"rb") as f:
+			magic = f.read(len(Maze.FILE_MAGIC))
+			if magic == Maze.FILE_MAGIC:
+				file_header = Maze.FILE_HEADER
+			elif magic == Maze.FILE_MAGIC_V1:
+				file_header = Maze.FILE_HEADER_V1
+			else:
+				raise ValueError("%s is not a maze file" % filename)
+			header = magic+f.read(file_header.size-len(magic))
+			if len(header) < file_header.size:
+				raise ValueError("%s is not a maze file" % filename)
+			if file_header is Maze.FILE_HEADER:
+				magic, num_cols, num_rows, cell_width, cell_height, wall_width, bHasSeed, seed = \
+					file_header.unpack(header)
+			else:
+				magic, num_cols, num_rows, cell_width, cell_height, wall_width, seed = \
+					file_header.unpack(header)
+				bHasSeed = seed != -1
+			num_cells = num_cols*num_rows
+			packed_size = int((num_cells+1)/2)
+			packed = f.read(packed_size+1)
+			if len(packed) != packed_size:
+				raise ValueError("%s is not a maze file" % filename)
+		cells = bytearray(num_cells)
+		cells[0::2] = packed.translate(Maze.UNPACK_LOW)
+		cells[1::2] = packed[:int(num_cells/2)].translate(Maze.UNPACK_HIGH)
+		if not bHasSeed:
+			seed = None
+		return Maze(num_cols,num_rows,cell_width,cell_height,wall_width,cells,seed)
 
 	def GetCellDimensions(self):
 		return (self.num_cols, self.num_rows)
@@ -430,44 +598,259 @@ class Maze:
 		return self.maze_rect
 
 	def Draw(self,surface,view_rect,wall_color=0xff0000):
-		start_col,start_row,cell_width,cell_height = self.GetCellRange(view_rect)
-		rects = self.rects
-		for c in range(cell_width):
-			col =  start_col+c
-			for r in range(cell_height):
-				row = start_row+r
-				for wall in rects[col][row]:
-					adjusted_wall = [ wall[0]-view_rect.left, wall[1]-view_rect.top, wall[2], wall[3] ]
-					if adjusted_wall[0] < 0:
-						adjusted_wall[2] = adjusted_wall[2] + adjusted_wall[0]
-						adjusted_wall[0] = 0
-					if adjusted_wall[1] < 0:
-						adjusted_wall[3] = adjusted_wall[3] + adjusted_wall[1]
-						adjusted_wall[1] = 0
-					surface.fill(wall_color,adjusted_wall)
+		if wall_color != self.tile_color:
+			self.tiles.clear()
+			self.tile_color = wall_color
+		tile_size = self.TILE_SIZE
+		maze_rect = self.maze_rect
+		start_col = max(view_rect.left,0)//tile_size
+		end_col = (min(view_rect.right,maze_rect.right)-1)//tile_size
+		start_row = max(view_rect.top,0)//tile_size
+		end_row = (min(view_rect.bottom,maze_rect.bottom)-1)//tile_size
+		for tile_row in range(start_row,end_row+1):
+			y = tile_row*tile_size-view_rect.top
+			for tile_col in range(start_col,end_col+1):
+				surface.blit(self._GetTile(tile_col,tile_row),
+							 (tile_col*tile_size-view_rect.left,y))
+
+	def _GetTile(self,tile_col,tile_row):
+		#Walls are rasterized once into fixed size tiles that are kept in
+		#a least recently used cache, so drawing is just a few blits.
+		key = (tile_col,tile_row)
+		tiles = self.tiles
+		tile = tiles.get(key)
+		if tile != None:
+			tiles.move_to_end(key)
+			return tile
+
+		tile_size = self.TILE_SIZE
+		tile_rect = pygame.Rect(tile_col*tile_size,tile_row*tile_size,
+								tile_size,tile_size)
+		colorkey = self.tile_color ^ 0xffffff
+		tile = pygame.Surface(tile_rect.size)
+		tile.fill(colorkey)
+		#Walls come straight from the cell bits.  fill() does not clip
+		#negative offsets, so clip them to the tile here.
+		for left, top, right, bottom in self._GetWalls(tile_rect.left,tile_rect.top,
+													  tile_rect.right,tile_rect.bottom):
+			left = max(left-tile_rect.left,0)
+			top = max(top-tile_rect.top,0)
+			tile.fill(self.tile_color,(left,top,
+									   right-tile_rect.left-left,
+									   bottom-tile_rect.top-top))
+		tile.set_colorkey(colorkey,RLEACCEL)
+
+		tiles[key] = tile
+		if len(tiles) > self.MAX_TILES:
+			tiles.popitem(last=False)
+		return tile
 
 	def Collide(self,rect):
-		retV = False
-		cell_col = int(rect.left/self.total_cell_width)
-		cell_row = int(rect.top/self.total_cell_height)
-		
-		for c in range(3):
-			col = cell_col-1+c
-			if col < 0 or col >= self.num_cols:
-				continue
-			for r in range(3):
-				row = cell_row-1+r
-				if row < 0 or row >= self.num_rows:
-					continue
-				for wall in self.rects[col][row]:
-					if rect.colliderect(*wall):
-						retV = True
-						break
-				if retV == True:
-					break
-			if retV == True:
-				break
-		return retV
+		return self.CollideBox(rect.left,rect.top,rect.right,rect.bottom)
+
+	def CollideBox(self,left,top,right,bottom):
+		#Collide for a box given as plain coordinates
+		total_cell_width = self.total_cell_width
+		total_cell_height = self.total_cell_height
+		if left < 0 or top < 0 or \
+		   right > self.maze_rect.width or bottom > self.maze_rect.height or \
+		   right-left >= total_cell_width or bottom-top >= total_cell_height:
+			return len(self._GetWalls(left,top,right,bottom)) > 0
+		if right <= left or bottom <= top:
+			return False
+
+		#The rect is smaller than a cell, so it spans at most two columns
+		#and two rows, and only a handful of wall bits need checking.
+		cells = self.cells
+		num_cols = self.num_cols
+		wall_width = self.wall_width
+		start_col, x_in_cell = divmod(left,total_cell_width)
+		end_col = (right-1)//total_cell_width
+		start_row = top//total_cell_height
+		end_row, y_in_cell = divmod(bottom-1,total_cell_height)
+		in_west_strip = x_in_cell < wall_width
+		in_south_strip = y_in_cell >= total_cell_height-wall_width
+
+		for r in range(start_row,end_row+1):
+			base = r*num_cols
+			if in_west_strip and not cells[base+start_col] & self.WEST:
+				return True
+			if end_col != start_col and not cells[base+end_col] & self.WEST:
+				return True
+			if r != end_row or in_south_strip:
+				if in_west_strip and start_col > 0 and \
+				   not cells[base+start_col-1] & self.SOUTH:
+					return True
+				for c in range(start_col,end_col+1):
+					if not cells[base+c] & self.SOUTH:
+						return True
+		if end_col == num_cols-1 and \
+		   (right-1)%total_cell_width >= total_cell_width-wall_width:
+			for r in range(start_row,end_row+1):
+				if not cells[r*num_cols+end_col] & self.EAST:
+					return True
+		if start_row == 0 and top < wall_width:
+			for c in range(start_col,end_col+1):
+				if not cells[c] & self.NORTH:
+					return True
+		return False
+
+	def GetFreeDistance(self,rect,offset,bVertical=False):
+		#How far (up to offset, keeping its sign) rect can slide along
+		#one axis before it would touch a wall.  This gives the same
+		#result as stepping a pixel at a time and stopping just before
+		#the first collision, including when rect starts out overlapping
+		#a wall it is moving away from.
+		return self.GetSlideDistance(rect.left,rect.top,rect.right,rect.bottom,
+									 offset,bVertical)
+
+	def GetSlideDistance(self,left,top,right,bottom,offset,bVertical=False):
+		#GetFreeDistance for a box given as plain coordinates
+		if offset == 0:
+			return 0
+		distance = abs(offset)
+		if bVertical:
+			start, end = top, bottom
+			if offset > 0:
+				bottom = bottom+distance
+			else:
+				top = top-distance
+			wall_start, wall_end = 1, 3
+		else:
+			start, end = left, right
+			if offset > 0:
+				right = right+distance
+			else:
+				left = left-distance
+			wall_start, wall_end = 0, 2
+
+		#Two exact shortcuts: if the first step already hits a wall the
+		#answer is 0, and if nothing is in the way of any of the steps
+		#the whole offset is free.
+		if bVertical:
+			if offset > 0:
+				if self.CollideBox(left,start+1,right,end+1):
+					return 0
+				if not self.CollideBox(left,start+1,right,bottom):
+					return offset
+			else:
+				if self.CollideBox(left,start-1,right,end-1):
+					return 0
+				if not self.CollideBox(left,top,right,end-1):
+					return offset
+		else:
+			if offset > 0:
+				if self.CollideBox(start+1,top,end+1,bottom):
+					return 0
+				if not self.CollideBox(start+1,top,right,bottom):
+					return offset
+			else:
+				if self.CollideBox(start-1,top,end-1,bottom):
+					return 0
+				if not self.CollideBox(left,top,end-1,bottom):
+					return offset
+
+		for wall in self._GetWalls(left,top,right,bottom):
+			#Range of steps for which the moved box overlaps this wall
+			if offset > 0:
+				first = max(1,wall[wall_start]-end+1)
+				last = wall[wall_end]-start-1
+			else:
+				first = max(1,start-wall[wall_end]+1)
+				last = end-wall[wall_start]-1
+			if first <= last and first <= distance:
+				distance = first-1
+		if offset < 0:
+			return 0-distance
+		return distance
+
+	def _GetWalls(self,left,top,right,bottom):
+		#Return the (left,top,right,bottom) extents of the walls that
+		#overlap the given box.  The walls are worked out straight from
+		#the cell bits and the fixed wall geometry: a west wall strip at
+		#the left of every cell, a south wall strip (reaching over the
+		#next cell's west strip) at the bottom of every cell, plus the
+		#north and east borders of the maze.  Strips that continue one
+		#another in a straight line are merged into a single run, so a
+		#long wall comes back as one box instead of one per cell.
+		walls = []
+		if right <= left or bottom <= top:
+			return walls
+		cells = self.cells
+		num_cols = self.num_cols
+		total_cell_width = self.total_cell_width
+		total_cell_height = self.total_cell_height
+		wall_width = self.wall_width
+
+		start_col = max(left//total_cell_width,0)
+		end_col = min((right-1)//total_cell_width,num_cols-1)
+		start_row = max(top//total_cell_height,0)
+		end_row = min((bottom-1)//total_cell_height,self.num_rows-1)
+		if start_col > end_col or start_row > end_row:
+			return walls
+
+		for c in range(start_col,end_col+1):
+			x = c*total_cell_width
+			if x+wall_width > left:
+				self._AddColumnRuns(walls,c,self.WEST,x,start_row,end_row)
+			if c == num_cols-1 and x+total_cell_width-wall_width < right:
+				self._AddColumnRuns(walls,c,self.EAST,x+total_cell_width-wall_width,
+									start_row,end_row)
+
+		for r in range(start_row,end_row+1):
+			y = r*total_cell_height
+			base = r*num_cols
+			if r == 0 and wall_width > top:
+				run_start = None
+				for c in range(start_col,end_col+2):
+					if c <= end_col and not cells[c] & self.NORTH:
+						if run_start == None:
+							run_start = c*total_cell_width
+					elif run_start != None:
+						walls.append( (run_start,0,c*total_cell_width,wall_width) )
+						run_start = None
+			if y+total_cell_height-wall_width < bottom:
+				y = y+total_cell_height-wall_width
+				run_start = None
+				for c in range(max(start_col-1,0),end_col+2):
+					if c <= end_col and not cells[base+c] & self.SOUTH and \
+					   (c+1)*total_cell_width+wall_width > left:
+						if run_start == None:
+							run_start = c*total_cell_width
+					elif run_start != None:
+						#The run ends with the last strip reaching over the
+						#next cell's west strip, unless it is at the border
+						if c == num_cols:
+							wall_right = c*total_cell_width
+						else:
+							wall_right = c*total_cell_width+wall_width
+						walls.append( (run_start,y,wall_right,y+wall_width) )
+						run_start = None
+		return walls
+
+	def _AddColumnRuns(self,walls,col,side,x,start_row,end_row):
+		#Add the runs of closed side strips (WEST or EAST) down one column
+		cells = self.cells
+		num_cols = self.num_cols
+		total_cell_height = self.total_cell_height
+		run_start = None
+		for r in range(start_row,end_row+2):
+			if r <= end_row and not cells[r*num_cols+col] & side:
+				if run_start == None:
+					run_start = r*total_cell_height
+			elif run_start != None:
+				walls.append( (x,run_start,x+self.wall_width,r*total_cell_height) )
+				run_start = None
+
+	def GetCellAt(self,x_pos,y_pos):
+		#The cell a maze position falls in, clamped to the maze
+		col = min(max(x_pos//self.total_cell_width,0),self.num_cols-1)
+		row = min(max(y_pos//self.total_cell_height,0),self.num_rows-1)
+		return (col,row)
+
+	def GetCellCenter(self,col,row):
+		return ( col*self.total_cell_width+self.wall_width+self.cell_width//2,
+				 row*self.total_cell_height+self.wall_width+self.cell_height//2 )
 
 	def GetCellRect(self,col,row):
 		return pygame.Rect( col*self.total_cell_width+self.wall_width,
@@ -476,22 +859,38 @@ class Maze:
 							self.cell_height )
 
 	def GetDeadEnds(self):
+		if self.dead_ends == None:
+			#Streamed, so this makes every row of the maze
+			return self.cells.ListDeadEnds(0,self.num_rows)
+		return self.ListDeadEnds(self.dead_ends,self.num_cols)
+
+	@staticmethod
+	def ListDeadEnds(dead_ends,num_cols):
+		#(col,row) of every cell marked in a DEAD_END_TABLE translation
 		retV = []
-		for r in range(self.num_rows):
-			for c in range(self.num_cols):
-				if self.IsDeadEnd(c,r):
-					retV.append( (c,r) )
+		index = dead_ends.find(1)
+		while index != -1:
+			row, col = divmod(index,num_cols)
+			retV.append( (col,row) )
+			index = dead_ends.find(1,index+1)
+		return retV
+
+	def GetDeadEndsInRow(self,row,start_col,end_col):
+		#Dead ends in columns start_col up to (not including) end_col
+		retV = []
+		offset = row*self.num_cols
+		dead_ends = self.dead_ends
+		if dead_ends == None:
+			offset = 0
+			dead_ends = self.cells.GetRow(row).translate(self.DEAD_END_TABLE)
+		index = dead_ends.find(1,offset+start_col,offset+end_col)
+		while index != -1:
+			retV.append( (index-offset,row) )
+			index = dead_ends.find(1,index+1,offset+end_col)
 		return retV
 
 	def IsDeadEnd(self,col,row):
-		cell = self.cells[row][col]
-		if cell == [False,False,False,True,True] or \
-		   cell == [False,False,True,False,True] or \
-		   cell == [False,True,False,False,True] or \
-		   cell == [True,False,False,False,True]:
-			   return True
-		else:
-			return False
+		return self.DEAD_END_TABLE[self.cells[row*self.num_cols+col]] == 1
 
 	def GetCellRange(self,rect):
 		start_col = int(rect.left/self.total_cell_width)
@@ -525,11 +924,13 @@ class Maze:
 		return( start_col, start_row, width, height)
 
 	def __str__( self ):
+		cells = self.cells
+		num_cols = self.num_cols
 		string = " "
-		for c in range(self.num_cols):
-			cell = self.cells[0][c]
-			if not cell[self.NORTH]:
-				if c == self.num_cols - 1:
+		for c in range(num_cols):
+			cell = cells[c]
+			if not cell & self.NORTH:
+				if c == num_cols - 1:
 					string = string + "_"
 				else:
 					string = string + "__"
@@ -537,24 +938,321 @@ class Maze:
 				string = string + "  "
 		string = string + "\n"
 		for r in range(self.num_rows):
-			for c in range(self.num_cols):
-				cell = self.cells[r][c]
-				if not cell[self.WEST]:
+			for c in range(num_cols):
+				cell = cells[r*num_cols+c]
+				if not cell & self.WEST:
 					string = string + "|"
 				else:
 					string = string + "_"
 					
-				if not cell[self.SOUTH]:
+				if not cell & self.SOUTH:
 					string = string + "_"
 				else:
 					string = string + " "
 				
-				if c == self.num_cols - 1:
-					if not cell[self.EAST]:
+				if c == num_cols - 1:
+					if not cell & self.EAST:
 						string = string + "|"
 			string = string + "\n"
 		return string
 
+class MazeRows:
+	#The cells of a maze too big to generate up front, laid out like
+	#Maze.cells but made with Eller's algorithm a band of rows at a
+	#time, only once something looks at them.  Eller's algorithm only
+	#carries one row of state from row to row, so the start of every
+	#band reached so far is kept as a checkpoint (which cells of the row
+	#above open south, and the sets they belong to) and any band can be
+	#made again from it.  Only the last MAX_BANDS bands used are kept.
+	BAND_ROWS = 64
+	MAX_BANDS = 32
+
+	def __init__(self,num_cols,num_rows,seed):
+		self.num_cols = num_cols
+		self.num_rows = num_rows
+		self.seed = seed
+		self.band_size = self.BAND_ROWS*num_cols
+		self.checkpoints = [ (bytes(num_cols),array.array("i",[-1])*num_cols) ]
+		self.bands = collections.OrderedDict()
+		self.last_index = None
+		self.last_band = None
+
+	def __len__(self):
+		return self.num_cols*self.num_rows
+
+	def __getitem__(self,index):
+		band_index, offset = divmod(index,self.band_size)
+		if band_index != self.last_index:
+			self.last_band = self._GetBand(band_index)
+			self.last_index = band_index
+		return self.last_band[offset]
+
+	def GetRow(self,row):
+		band_index, band_row = divmod(row,self.BAND_ROWS)
+		offset = band_row*self.num_cols
+		return self._GetBand(band_index)[offset:offset+self.num_cols]
+
+	def GetRows(self,start_row,end_row):
+		#The cells of rows start_row up to (not including) end_row
+		retV = bytearray()
+		row = start_row
+		while row < end_row:
+			band_index, band_row = divmod(row,self.BAND_ROWS)
+			rows = min(self.BAND_ROWS-band_row,end_row-row)
+			offset = band_row*self.num_cols
+			retV.extend(self._GetBand(band_index)[offset:offset+rows*self.num_cols])
+			row = row+rows
+		return retV
+
+	def ListDeadEnds(self,start_row,end_row):
+		#(col,row) of every dead end in rows start_row up to end_row
+		retV = []
+		for col, row in Maze.ListDeadEnds(self.GetRows(start_row,end_row).translate(Maze.DEAD_END_TABLE),
+										  self.num_cols):
+			retV.append( (col,row+start_row) )
+		return retV
+
+	def _GetBand(self,band_index):
+		bands = self.bands
+		band = bands.get(band_index)
+		if band != None:
+			bands.move_to_end(band_index)
+			return band
+		#Bands past the last checkpoint have to be made in order first
+		while len(self.checkpoints) <= band_index:
+			self._Generate(len(self.checkpoints)-1)
+		return self._Generate(band_index)
+
+	def _Generate(self,band_index):
+		NORTH, SOUTH, EAST, WEST = Maze.NORTH, Maze.SOUTH, Maze.EAST, Maze.WEST
+		VISITED = Maze.VISITED
+		num_cols = self.num_cols
+		first_row = band_index*self.BAND_ROWS
+		num_rows = min(self.BAND_ROWS,self.num_rows-first_row)
+		rand = random.Random("%d:%d" % (self.seed,band_index)).random
+		south, labels = self.checkpoints[band_index]
+		labels = list(labels)
+		next_label = max(labels)+1
+		cells = bytearray(num_rows*num_cols)
+		for r in range(num_rows):
+			base = r*num_cols
+			bLastRow = first_row+r == self.num_rows-1
+			#Cells not joined to the row above start sets of their own
+			members = {}
+			for c in range(num_cols):
+				if labels[c] < 0:
+					labels[c] = next_label
+					next_label = next_label+1
+				members.setdefault(labels[c],[]).append(c)
+				if south[c]:
+					cells[base+c] = VISITED | NORTH
+				else:
+					cells[base+c] = VISITED
+			#Join neighbors in different sets at random, and all of them on
+			#the last row so the whole maze ends up as one set.  The smaller
+			#set is relabeled, which keeps a row from costing cols squared.
+			for c in range(num_cols-1):
+				label = labels[c]
+				old_label = labels[c+1]
+				if label != old_label and (bLastRow or rand() < 0.5):
+					cells[base+c] = cells[base+c] | EAST
+					cells[base+c+1] = cells[base+c+1] | WEST
+					if len(members[label]) < len(members[old_label]):
+						label, old_label = old_label, label
+					moved = members.pop(old_label)
+					for i in moved:
+						labels[i] = label
+					members[label].extend(moved)
+			if bLastRow:
+				break
+			#Every set carries on into the next row through at least one
+			#cell, tried in column order
+			members = {}
+			for c in range(num_cols):
+				members.setdefault(labels[c],[]).append(c)
+			south = bytearray(num_cols)
+			for cols in members.values():
+				chosen = [ c for c in cols if rand() < 0.5 ]
+				if len(chosen) == 0:
+					chosen = [ cols[int(rand()*len(cols))] ]
+				for c in chosen:
+					south[c] = 1
+					cells[base+c] = cells[base+c] | SOUTH
+			for c in range(num_cols):
+				if not south[c]:
+					labels[c] = -1
+
+		if band_index+1 == len(self.checkpoints) and first_row+num_rows < self.num_rows:
+			#Number the sets in order of appearance, so a band made again
+			#from its checkpoint comes out the same
+			numbers = {}
+			for c in range(num_cols):
+				if labels[c] >= 0:
+					labels[c] = numbers.setdefault(labels[c],len(numbers))
+			self.checkpoints.append( (bytes(south),array.array("i",labels)) )
+
+		bands = self.bands
+		bands[band_index] = cells
+		if len(bands) > self.MAX_BANDS:
+			bands.popitem(last=False)
+			self.last_index = None
+		return cells
+
+class FarDistances(dict):
+	#Distances for a flow field that only reaches so far.  Cells it did
+	#not reach read as one step further than it goes.
+	def __init__(self,far):
+		dict.__init__(self)
+		self.far = far
+	def __missing__(self,index):
+		return self.far
+
+class FlowField:
+	#Distance (in cells) from every maze cell to a root cell, usually
+	#the one Shaggy is in.  Anything chasing or fleeing the root reads
+	#its next cell from here instead of searching the maze itself.
+	#Stored distances are offset by self.bias, which lets a move of the
+	#root to a neighboring cell touch only the smaller half of the maze.
+	#Given a max_distance, only the cells that close to the root are
+	#searched and stored, for mazes too big to search as a whole.
+	def __init__(self,maze,max_distance=None):
+		self.maze = maze
+		self.max_distance = max_distance
+		if max_distance == None:
+			self.dist = array.array("i",[0])*(maze.num_cols*maze.num_rows)
+		else:
+			self.dist = FarDistances(max_distance+1)
+		self.bias = 0
+		self.root = None
+
+	def SetRoot(self,col,row):
+		index = row*self.maze.num_cols+col
+		if index == self.root:
+			return
+		if self.max_distance != None:
+			self._SearchNear(index)
+		elif self.root != None and index in self._GetNeighbors(self.root):
+			self._ShiftRoot(index)
+		else:
+			self._Search(index)
+		self.root = index
+
+	def GetRoot(self):
+		if self.root == None:
+			return None
+		row, col = divmod(self.root,self.maze.num_cols)
+		return (col,row)
+
+	def GetDistance(self,col,row):
+		return self.dist[row*self.maze.num_cols+col]+self.bias
+
+	def GetNextCell(self,col,row,bFlee=False):
+		#The open neighbor one step closer to the root, or when fleeing
+		#one step further away.  None at the root or in a dead end when
+		#fleeing, or when the cell is out of the field's reach.
+		index = row*self.maze.num_cols+col
+		dist = self.dist
+		if self.max_distance != None and index not in dist:
+			return None
+		best = None
+		best_dist = dist[index]
+		for neighbor in self._GetNeighbors(index):
+			neighbor_dist = dist[neighbor]
+			if bFlee:
+				if neighbor_dist > best_dist:
+					best, best_dist = neighbor, neighbor_dist
+			elif neighbor_dist < best_dist:
+				best, best_dist = neighbor, neighbor_dist
+		if best == None:
+			return None
+		row, col = divmod(best,self.maze.num_cols)
+		return (col,row)
+
+	def _GetNeighbors(self,index):
+		maze = self.maze
+		cell = maze.cells[index]
+		neighbors = []
+		if cell & Maze.NORTH:
+			neighbors.append(index-maze.num_cols)
+		if cell & Maze.SOUTH:
+			neighbors.append(index+maze.num_cols)
+		if cell & Maze.EAST:
+			neighbors.append(index+1)
+		if cell & Maze.WEST:
+			neighbors.append(index-1)
+		return neighbors
+
+	def _Search(self,root):
+		#Breadth first search over the open passages from root
+		dist = self.dist
+		get_neighbors = self._GetNeighbors
+		self.bias = 0
+		dist[root] = 0
+		seen = bytearray(len(dist))
+		seen[root] = 1
+		frontier = [root]
+		depth = 0
+		while len(frontier) > 0:
+			depth = depth + 1
+			next_frontier = []
+			for index in frontier:
+				for neighbor in get_neighbors(index):
+					if not seen[neighbor]:
+						seen[neighbor] = 1
+						dist[neighbor] = depth
+						next_frontier.append(neighbor)
+			frontier = next_frontier
+
+	def _SearchNear(self,root):
+		#Breadth first search from root out to max_distance
+		dist = FarDistances(self.max_distance+1)
+		get_neighbors = self._GetNeighbors
+		dist[root] = 0
+		frontier = [root]
+		for depth in range(1,self.max_distance+1):
+			next_frontier = []
+			for index in frontier:
+				for neighbor in get_neighbors(index):
+					if neighbor not in dist:
+						dist[neighbor] = depth
+						next_frontier.append(neighbor)
+			frontier = next_frontier
+		self.dist = dist
+
+	def _ShiftRoot(self,new_root):
+		#The maze is a tree, so when the root moves one cell every cell
+		#on the new root's side gets one closer and every other cell one
+		#further.  Flood both sides a step at a time and only rewrite the
+		#one that runs out first; the bias covers the other.
+		old_root = self.root
+		get_neighbors = self._GetNeighbors
+		sides = [ ([new_root],[new_root],set([new_root,old_root])),
+				  ([old_root],[old_root],set([old_root,new_root])) ]
+		done = None
+		while done == None:
+			for side in range(2):
+				members, frontier, seen = sides[side]
+				next_frontier = []
+				for index in frontier:
+					for neighbor in get_neighbors(index):
+						if neighbor not in seen:
+							seen.add(neighbor)
+							members.append(neighbor)
+							next_frontier.append(neighbor)
+				sides[side] = (members,next_frontier,seen)
+				if len(next_frontier) == 0:
+					done = side
+					break
+		dist = self.dist
+		if done == 0:
+			self.bias = self.bias+1
+			for index in sides[0][0]:
+				dist[index] = dist[index]-2
+		else:
+			self.bias = self.bias-1
+			for index in sides[1][0]:
+				dist[index] = dist[index]+2
+
 def _default_level_info(level_num):
 	shaggy_speed = 5 + int(level_num/20)
 	ghost_speed =  2 + ( 2 * int(level_num/20) )
@@ -580,6 +1278,586 @@ class MouseTarget:
 		view_rect = self.view_rect
 		pygame.mouse.set_pos((x_pos-view_rect.left,y_pos-view_rect.top))
 
+class EntityRegistry:
+	#Compact state for any number of look-alike maze objects (the ghosts,
+	#or Scooby).  Positions and images are kept in parallel arrays indexed
+	#by entity id; an id stays the same for as long as its entity lives
+	#and is handed out again once it is removed.  Tags are sets of ids.
+	#Entities are bucketed by the maze cell their center is in (kept as
+	#a row major cell index, -1 once removed), so that
+	#collision and position queries only look at the nearby ones.  An
+	#entity is always smaller than a cell, so any entity touching a rect
+	#has its center in a cell within one of the rect's cells.  Sprites
+	#are only made for the entities in view, from a pool.
+	def __init__(self,demo,maze):
+		self.maze = maze
+		self.demo = demo
+
+		#The demo's images by slot, and the slot MazeObject.Face would
+		#turn each slot into for every direction of movement
+		image_types = sorted(demo.images.keys())
+		self.images = [ demo.images[img_type] for img_type in image_types ]
+		self.sizes = [ image.get_size() for image in self.images ]
+		self.start_slot = self.images.index(demo.image)
+		self.face_table = []
+		facer = MazeObject(demo=demo)
+		for image in self.images:
+			for x_offset in [-1,0,1]:
+				for y_offset in [-1,0,1]:
+					facer.image = image
+					if x_offset != 0 or y_offset != 0:
+						facer.Face(x_offset,y_offset)
+					self.face_table.append(self.images.index(facer.image))
+
+		self.left = array.array("i")
+		self.top = array.array("i")
+		self.slot = bytearray()
+		self.cell = array.array("i")
+		self.free = []
+		self.count = 0
+		self.buckets = {}
+		self.tags = collections.defaultdict(set)
+		self.sprites = {}
+		self.sprite_pool = []
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		#Live ids, in increasing order
+		cell = self.cell
+		return iter([ id for id in range(len(cell)) if cell[id] >= 0 ])
+
+	def _GetCell(self,id):
+		maze = self.maze
+		width, height = self.sizes[self.slot[id]]
+		return ((self.top[id]+height//2)//maze.total_cell_height)*maze.num_cols + \
+			   (self.left[id]+width//2)//maze.total_cell_width
+
+	def _File(self,id):
+		cell = self._GetCell(id)
+		self.cell[id] = cell
+		bucket = self.buckets.get(cell)
+		if bucket == None:
+			self.buckets[cell] = [id]
+		else:
+			bucket.append(id)
+
+	def _Unfile(self,id):
+		cell = self.cell[id]
+		bucket = self.buckets[cell]
+		bucket.remove(id)
+		if len(bucket) == 0:
+			del self.buckets[cell]
+
+	def Add(self,center):
+		#Add an entity centered on the given maze position and return its id
+		width, height = self.sizes[self.start_slot]
+		left = center[0]-width//2
+		top = center[1]-height//2
+		if len(self.free) > 0:
+			id = self.free.pop()
+			self.left[id] = left
+			self.top[id] = top
+			self.slot[id] = self.start_slot
+		else:
+			id = len(self.cell)
+			self.left.append(left)
+			self.top.append(top)
+			self.slot.append(self.start_slot)
+			self.cell.append(-1)
+		self._File(id)
+		self.count = self.count+1
+		return id
+
+	def Remove(self,id):
+		self._Unfile(id)
+		self.cell[id] = -1
+		for tagged in self.tags.values():
+			tagged.discard(id)
+		sprite = self.sprites.pop(id,None)
+		if sprite != None:
+			sprite.kill()
+			self.sprite_pool.append(sprite)
+		self.free.append(id)
+		self.count = self.count-1
+
+	def IsAlive(self,id):
+		return id < len(self.cell) and self.cell[id] >= 0
+
+	def GetCell(self,id):
+		#The (col,row) of the cell the entity's center is in
+		row, col = divmod(self.cell[id],self.maze.num_cols)
+		return (col,row)
+
+	def GetMazeRect(self,id):
+		width, height = self.sizes[self.slot[id]]
+		return pygame.Rect(self.left[id],self.top[id],width,height)
+
+	def GetPosition(self,id):
+		width, height = self.sizes[self.slot[id]]
+		return (self.left[id]+width//2,self.top[id]+height//2)
+
+	def Face(self,id,x_offset,y_offset):
+		#Pick the image for the given movement, like MazeObject.Face
+		x_sign = (x_offset > 0)-(x_offset < 0)
+		y_sign = (y_offset > 0)-(y_offset < 0)
+		self.slot[id] = self.face_table[self.slot[id]*9+(x_sign+1)*3+y_sign+1]
+
+	def SetPosition(self,id,left,top):
+		self.left[id] = left
+		self.top[id] = top
+		if self._GetCell(id) != self.cell[id]:
+			self._Unfile(id)
+			self._File(id)
+
+	def Tag(self,id,tag):
+		self.tags[tag].add(id)
+
+	def GetTagged(self,tag):
+		#Ids with the tag, in increasing order
+		return sorted(self.tags[tag])
+
+	def ClearTag(self,tag):
+		self.tags[tag].clear()
+
+	def GetInCell(self,col,row):
+		#Ids of the entities centered in the given cell
+		return self.buckets.get(row*self.maze.num_cols+col,[])
+
+	def GetColliding(self,rect,bFirst=False):
+		maze = self.maze
+		num_cols = maze.num_cols
+		start_col = max(rect.left//maze.total_cell_width-1,0)
+		end_col = min((rect.right-1)//maze.total_cell_width+1,num_cols-1)
+		start_row = max(rect.top//maze.total_cell_height-1,0)
+		end_row = min((rect.bottom-1)//maze.total_cell_height+1,maze.num_rows-1)
+		buckets = self.buckets
+		lefts = self.left
+		tops = self.top
+		slots = self.slot
+		sizes = self.sizes
+		retV = []
+		for col in range(start_col,end_col+1):
+			for row in range(start_row,end_row+1):
+				bucket = buckets.get(row*num_cols+col)
+				if bucket == None:
+					continue
+				for id in bucket:
+					width, height = sizes[slots[id]]
+					if rect.colliderect((lefts[id],tops[id],width,height)):
+						retV.append(id)
+						if bFirst:
+							return retV
+		return retV
+
+	def Collide(self,rect):
+		#Any one entity touching rect, or None
+		ids = self.GetColliding(rect,True)
+		if len(ids) > 0:
+			return ids[0]
+		return None
+
+	def UpdateSprites(self,group,view_rect):
+		#Give every entity in view a sprite in group, placed for the view,
+		#and put the sprites of the ones that left it back in the pool
+		visible = set(self.GetColliding(view_rect))
+		sprites = self.sprites
+		for id in list(sprites.keys()):
+			if id not in visible:
+				sprite = sprites.pop(id)
+				group.remove(sprite)
+				self.sprite_pool.append(sprite)
+		for id in sorted(visible):
+			sprite = sprites.get(id)
+			if sprite == None:
+				if len(self.sprite_pool) > 0:
+					sprite = self.sprite_pool.pop()
+				else:
+					sprite = MazeObject(demo=self.demo)
+				sprites[id] = sprite
+				group.add(sprite)
+			image = self.images[self.slot[id]]
+			if sprite.image is not image:
+				sprite.image = image
+				sprite.rect.size = sprite.maze_rect.size = image.get_size()
+			sprite.SetPosition(self.left[id],self.top[id])
+			sprite.update(view_rect)
+
+class TickClock:
+	#Game time for the fixed timestep simulation.  Every tick moves it on
+	#by exactly one tick and never sleeps, so the game plays the same on
+	#any machine and everything in one tick sees the same time.
+	def __init__(self):
+		self.time = 0.0
+	def tick(self,framerate=0):
+		self.time = self.time + 1.0/float(TICKS_PER_SECOND)
+		return self.get_time()
+	def get_time(self):
+		return int(1000.0/float(TICKS_PER_SECOND))
+	def get_fps(self):
+		return float(TICKS_PER_SECOND)
+	def now(self):
+		return self.time
+
+class ReplayClock:
+	#Plays back the clock readings of a recorded session, one frame at
+	#a time
+	def __init__(self):
+		self.time = 0.0
+		self.frame_time = 0
+		self.fps = 0.0
+	def SetFrame(self,now,frame_time,fps):
+		self.time = now
+		self.frame_time = frame_time
+		self.fps = fps
+	def tick(self,framerate=0):
+		return self.frame_time
+	def get_time(self):
+		return self.frame_time
+	def get_fps(self):
+		return self.fps
+	def now(self):
+		return self.time
+
+class FixedTarget:
+	#Something to chase that stays where it is put, standing in for the
+	#mouse when frames are driven by recorded input
+	def __init__(self,pos):
+		self.pos = pos
+	def GetPosition(self):
+		return self.pos
+
+class SessionRecorder:
+	#Records what is needed to play a session back exactly: the seed of
+	#every level played and, for every frame, the input and the clock.
+	#Each level ends with its outcome and where everything ended up, so
+	#a replay can check that it came out the same.
+	def __init__(self,game):
+		self.session = { "version"    : 1,
+						 "seed"       : game.seed,
+						 "level_info" : game.level_info.__name__,
+						 "levels"     : [] }
+		self.current = None
+
+	def StartLevel(self,game,level):
+		self.current = { "level"     : level.level_num,
+						 "seed"      : level.seed,
+						 "start"     : game.clock.now(),
+						 "use_mouse" : game.bUseMouse,
+						 "direction" : game.shaggy.GetDirection(),
+						 "frames"    : [] }
+		self.session["levels"].append(self.current)
+
+	def RecordFrame(self,frame_input,clock):
+		#[quit, door, toggle mouse, x offset, y offset, mouse x, mouse y,
+		# now, frame time, fps]
+		bQuit, bUseDoor, bToggleMouse, x_offset, y_offset, mouse_pos = frame_input
+		if mouse_pos == None:
+			mouse_pos = (None,None)
+		self.current["frames"].append( [ int(bQuit), int(bUseDoor), int(bToggleMouse),
+										 x_offset, y_offset, mouse_pos[0], mouse_pos[1],
+										 clock.now(), clock.get_time(), clock.get_fps() ] )
+
+	def EndLevel(self,state,fingerprint):
+		if self.current != None:
+			self.current["result"] = state
+			self.current["fingerprint"] = fingerprint
+			self.current = None
+
+	def Save(self,filename):
+		with open(filename,"w") as f:
+			json.dump(self.session,f)
+
+class FrameProfiler:
+	#Times the phases of every frame, adding up the phases of all the
+	#ticks run for it.  The last WINDOW frames are kept
+	#for the on screen overlay's percentiles and every level gets a
+	#histogram of each phase, written to the log as a JSON line when the
+	#level ends so runs on different machines and levels can be compared.
+	PHASES = ["input","shaggy","camera","ghosts","doors","sprite_update",
+			  "maze_draw","sprites","overlay","flip","rules"]
+	#Upper edges of the histogram buckets in milliseconds, the last
+	#bucket holds everything slower
+	BUCKETS = [0.25,0.5,1.0,2.0,4.0,8.0,16.0,33.0,66.0]
+	WINDOW = 120
+
+	def __init__(self):
+		self.log = None
+		self.last = None
+		self.times = dict.fromkeys(self.PHASES,0.0)
+		self.recent = {}
+		for phase in self.PHASES+["frame"]:
+			self.recent[phase] = collections.deque(maxlen=self.WINDOW)
+		self.level = None
+		self.start = self.last = time.perf_counter()
+
+	def StartFrame(self):
+		for phase in self.PHASES:
+			self.times[phase] = 0.0
+		self.start = self.last = time.perf_counter()
+
+	def Mark(self,phase):
+		#Charge the time since the last mark to phase
+		now = time.perf_counter()
+		self.times[phase] = self.times[phase]+(now-self.last)
+		self.last = now
+
+	def EndFrame(self):
+		self._Add("frame",time.perf_counter()-self.start)
+		for phase in self.PHASES:
+			self._Add(phase,self.times[phase])
+		if self.level != None:
+			self.level["frames"] = self.level["frames"]+1
+
+	def _Add(self,phase,seconds):
+		ms = seconds*1000.0
+		self.recent[phase].append(ms)
+		if self.level != None:
+			stats = self.level["phases"][phase]
+			stats["counts"][bisect.bisect_left(self.BUCKETS,ms)] += 1
+			stats["total_ms"] = stats["total_ms"]+ms
+			stats["max_ms"] = max(stats["max_ms"],ms)
+
+	def GetPercentiles(self,phase,percentiles):
+		recent = sorted(self.recent[phase])
+		if len(recent) == 0:
+			return [ 0.0 for p in percentiles ]
+		return [ recent[int(p*(len(recent)-1)/100)] for p in percentiles ]
+
+	def StartLevel(self,game,level):
+		self.level = { "level"       : level.level_num,
+					   "level_info"  : game.level_info.__name__,
+					   "seed"        : level.seed,
+					   "headless"    : game.bHeadless,
+					   "dirty_rects" : game.bDirtyRects,
+					   "machine"     : platform.machine(),
+					   "processor"   : platform.processor(),
+					   "system"      : platform.system(),
+					   "python"      : platform.python_version(),
+					   "pygame"      : pygame.version.ver,
+					   "buckets_ms"  : self.BUCKETS,
+					   "frames"      : 0,
+					   "phases"      : {} }
+		for phase in self.PHASES+["frame"]:
+			self.level["phases"][phase] = { "counts"   : [0]*(len(self.BUCKETS)+1),
+											"total_ms" : 0.0,
+											"max_ms"   : 0.0 }
+
+	def EndLevel(self,state):
+		if self.level != None:
+			self.level["result"] = state
+			if self.log != None:
+				self.log.write(json.dumps(self.level)+"\n")
+				self.log.flush()
+			self.level = None
+
+class LevelLayout:
+	#A compact description of a generated level: the maze's wall bits, its
+	#doors and the cells everything starts in.  There are no pygame
+	#objects in it, so it can be built in a worker process, pickled back
+	#and turned into a Level by the game.  A seeded layout always comes
+	#out the same.
+	#A streamed maze (see Maze.STREAM_CELLS) keeps no cells or doors here,
+	#just its seed.  Shaggy starts in a door in its first band of rows.
+	#Ghosts keep out of that band's doors and the cells around Shaggy,
+	#but are otherwise placed (like Scooby) without looking at the cells.
+	def __init__(self,level_info,level_num,seed=None):
+		self.level_num = level_num
+		self.seed = seed
+		num_cols, num_rows, num_ghosts, shaggy_speed, ghost_speed, scooby_speed = level_info(level_num)
+		self.bStreamed = num_cols*num_rows > Maze.STREAM_CELLS
+		if seed == None:
+			rand = random
+			maze_seed = None
+			if self.bStreamed:
+				maze_seed = random.getrandbits(63)
+		else:
+			rand = random.Random(seed)
+			maze_seed = rand.getrandbits(63)
+		self.shaggy_speed = shaggy_speed
+		self.ghost_speed = ghost_speed
+		self.scooby_speed = scooby_speed
+		self.num_cols = num_cols
+		self.num_rows = num_rows
+		self.maze_seed = maze_seed
+		if self.bStreamed:
+			self.cells = None
+			self.door_locations = None
+			self.door_exits = None
+			rows = MazeRows(num_cols,num_rows,maze_seed)
+			doors = rows.ListDeadEnds(0,min(MazeRows.BAND_ROWS,num_rows))
+			self._GenerateShaggy(rand,doors)
+			self._GenerateScooby(rand,None)
+			reserved = set(doors)
+			col, row = self.shaggy_start
+			for c in range(max(0,col-1),min(num_cols,col+2)):
+				for r in range(max(0,row-1),min(num_rows,row+2)):
+					reserved.add( (c,r) )
+			self._GenerateGhosts(rand,None,num_ghosts,reserved)
+			return
+		self.cells = Maze.GenerateCells(num_cols,num_rows,maze_seed)
+		dead_ends = self.cells.translate(Maze.DEAD_END_TABLE)
+
+		self.door_locations = Maze.ListDeadEnds(dead_ends,num_cols)
+		self._BuildDoorExits()
+		self._GenerateShaggy(rand,self.door_locations)
+		self._GenerateScooby(rand,dead_ends)
+		self._GenerateGhosts(rand,dead_ends,num_ghosts)
+
+	def _GenerateShaggy(self,rand,door_locations):
+		index = rand.randint(0,len(door_locations)-1)
+		self.shaggy_start = door_locations[index]
+
+	def _GenerateScooby(self,rand,dead_ends):
+		num_cols, num_rows = self.num_cols, self.num_rows
+		while True:
+			row = rand.randint(0,num_rows-1)
+			col = rand.randint(0,num_cols-1)
+			if (dead_ends != None and dead_ends[row*num_cols+col]) or \
+				abs(self.shaggy_start[0]-col) < int(num_cols/4) or \
+				abs(self.shaggy_start[1]-row) < int(num_rows/4):
+					continue
+			else:
+				self.scooby_start = (col,row)
+				break
+
+	def _BuildDoorExits(self):
+		#Work out where every door leads now, so using a door is just a
+		#lookup
+		doors_by_col = {}
+		doors_by_row = {}
+		for col, row in self.door_locations:
+			doors_by_col.setdefault(col,[]).append(row)
+			doors_by_row.setdefault(row,[]).append(col)
+		self.door_exits = {}
+		for door_index, (col,row) in enumerate(self.door_locations):
+			self.door_exits[(col,row)] = (door_index,
+										  self.FindDoorExits(doors_by_col,doors_by_row,col,row,
+															 self.num_cols,self.num_rows))
+
+	@staticmethod
+	def FindDoorExits(doors_by_col,doors_by_row,col,row,num_cols,num_rows,bWrapRows=True):
+		#Going through a door facing up or down leads to the first door found
+		#in the rows ahead, searching the door's own column and the columns on
+		#either side and wrapping around the maze.  Within a row the door's own
+		#column wins, then whichever neighbor b_less_than_first favors.  Left
+		#and right work the same way over columns.  doors_by_col and
+		#doors_by_row hold the sorted rows of the doors in each column and
+		#the sorted columns of the doors in each row.  Returns the target
+		#for each direction*2+b_less_than_first; None means the search finds
+		#nothing.  Without bWrapRows the search up and down stops at the
+		#first and last rows given.
+		exits = []
+		for doors_by_line, line, pos, size, bWrap in [ (doors_by_col,col,row,num_rows,bWrapRows),
+													   (doors_by_row,row,col,num_cols,True) ]:
+			for adder in [-1,1]:
+				#Nearest door ahead on this line and the two beside it
+				found = {}
+				for l in [line,line-1,line+1]:
+					doors = doors_by_line.get(l)
+					if doors == None or len(doors) == 0:
+						continue
+					if adder > 0:
+						i = bisect.bisect_right(doors,pos)
+						if i == len(doors) and not bWrap:
+							continue
+						p = doors[i%len(doors)]
+						distance = (p-pos)%size
+					else:
+						i = bisect.bisect_left(doors,pos)-1
+						if i < 0 and not bWrap:
+							continue
+						p = doors[i]
+						distance = (pos-p)%size
+					if distance == 0:
+						if l == line:
+							#The only door on its own line is this one
+							continue
+						distance = size
+					found[l] = (distance,p)
+				for b_less_than_first in [0,1]:
+					if b_less_than_first:
+						line_list = [line,line-1,line+1]
+					else:
+						line_list = [line,line+1,line-1]
+					target = None
+					best = None
+					for l in line_list:
+						if l in found and (best == None or found[l][0] < best):
+							best, p = found[l]
+							if doors_by_line is doors_by_col:
+								target = (l,p)
+							else:
+								target = (p,l)
+					exits.append(target)
+		return exits
+
+	def _GenerateGhosts(self,rand,dead_ends,num_ghosts,reserved=None):
+		#Ghosts start one to a cell and never in a door.  Without the
+		#dead ends (a streamed maze), they keep out of the reserved cells
+		#instead.
+		self.ghost_starts = []
+		ghost_starts = self.ghost_starts
+		occupied = set()
+		num_cols, num_rows = self.num_cols, self.num_rows
+		if dead_ends != None:
+			available_cells = (num_cols*num_rows)-len(self.door_locations)
+		else:
+			available_cells = (num_cols*num_rows)-len(reserved)
+			occupied.update(reserved)
+		for i in range(num_ghosts):
+			if len(ghost_starts) >= available_cells:
+				break
+			while True:
+				row = rand.randint(0,num_rows-1)
+				col = rand.randint(0,num_cols-1)
+				if (dead_ends != None and dead_ends[row*num_cols+col]) or (col,row) in occupied:
+					continue
+				else:
+					ghost_starts.append( (col,row) )
+					occupied.add( (col,row) )
+					break
+
+class Level:
+	#A LevelLayout turned into the maze and sprites the game plays with.
+	#Building one only reads from the game, so a level can be made ready
+	#ahead of time and then swapped in with Game._InstallLevel.
+	def __init__(self,game,layout):
+		self.level_num = layout.level_num
+		self.seed = layout.seed
+		self.shaggy_speed = layout.shaggy_speed
+		self.ghost_speed = layout.ghost_speed
+		self.scooby_speed = layout.scooby_speed
+		cells = layout.cells
+		if layout.bStreamed:
+			cells = MazeRows(layout.num_cols,layout.num_rows,layout.maze_seed)
+		self.maze = Maze(layout.num_cols,layout.num_rows,
+							game.max_sprite_width+(2*self.shaggy_speed),
+							game.max_sprite_height+(2*self.shaggy_speed),10,
+							cells,layout.maze_seed)
+		if layout.bStreamed:
+			#Far enough to cover every ghost that is awake
+			self.flow_field = FlowField(self.maze,2*GHOST_FAR_CELLS)
+		else:
+			self.flow_field = FlowField(self.maze)
+
+		self.door_locations = layout.door_locations
+		self.door_exits = layout.door_exits
+		self.door_pool = []
+		rect = pygame.Rect(0,0,game.view_rect.width,game.view_rect.height)
+		c,r,width,height = self.maze.GetCellRange(rect)
+		for x in range((width+1)*(height+1)):
+			self.door_pool.append(MazeObject(demo=game.demo_door))
+
+		self.shaggy_start = layout.shaggy_start
+		self.scooby = EntityRegistry(game.demo_scooby,self.maze)
+		self.scooby_id = self.scooby.Add(self.maze.GetCellRect(*layout.scooby_start).center)
+
+		self.ghosts = EntityRegistry(game.demo_ghost,self.maze)
+		for cell in layout.ghost_starts:
+			self.ghosts.Add(self.maze.GetCellRect(*cell).center)
+
 class Game:
 	OPENING_PLAY = 0
 	OPENING      = 1
@@ -591,10 +1869,20 @@ class Game:
 	WINNER_PLAY  = 8
 	WINNER       = 9
 	QUIT         = 10
-	def __init__(self,level_info=_default_level_info,start_level=1):
+	def __init__(self,level_info=_default_level_info,start_level=1,
+				 bDirtyRects=False,bHeadless=False,seed=None):
 		#General pygame intialization
+		self.bHeadless = bHeadless
+		if bHeadless:
+			#No window and no sound card
+			os.environ["SDL_VIDEODRIVER"] = "dummy"
+			os.environ["SDL_AUDIODRIVER"] = "dummy"
+		#Game time moves on a tick at a time, the frame clock only paces
+		#the drawing
+		self.clock = TickClock()
+		self.frame_clock = pygame.time.Clock()
+		self.tick_lag = 0.0
 		pygame.init()
-		self.clock = pygame.time.Clock()
 		try:
 			self.joystick = pygame.joystick.Joystick(0)
 		except pygame.error as msg:
@@ -602,18 +1890,26 @@ class Game:
 			self.joystick = None
 		else:
 			self.joystick.init()
-		self.bUseMouse = True
+		self.bUseMouse = not bHeadless
 		self.mouse_target = None
 		
 		#Initalize background image and view port
 		self.background = load_image("background.bmp",False)
 		self.screen	 = pygame.display.set_mode(self.background.get_size())
+		asset_pack.Open()
 		self.background.convert()
 		self.view_rect  = pygame.Rect(0,0,0,0)
 		self.panx_inc = 0
 		self.pany_inc = 0
 		self.view_rect.size = self.background.get_size()
 
+		#With dirty rects on, frames where the view has not moved only
+		#redraw and push the areas under the sprites.
+		self.bDirtyRects = bDirtyRects
+		self.bFullRedraw = True
+		self.last_view_topleft = None
+		self.drawn_rects = []
+
 		#Initialize the maze and the objects that go in it
 		self.shaggy	  = MazeObject("shaggy")
 		self.bang		= MazeObject("bang")
@@ -621,7 +1917,6 @@ class Game:
 		self.demo_scooby = MazeObject("scooby")
 		self.demo_door   = MazeObject("door")
 		self.target_door = MazeObject("target_door")
-		self.target_ghosts = []
 
 		max_width  = 0
 		max_height = 0
@@ -643,6 +1938,10 @@ class Game:
 
 		self.door_pool = []
 		self.door_locations = []
+		self.door_exits = {}
+		self.visible_doors = {}
+		self.door_window = None
+		self.target_door_cell = None
 
 		self.maze = None
 		self.shaggy_speed = 1
@@ -655,24 +1954,43 @@ class Game:
 		self.level_info = level_info
 		self.bConsolidateGhosts = False
 
-		self.quick_attack_rect = pygame.Rect(0,0,0,0)
-		self.quick_attack_rect.width = self.view_rect.width*2
-		self.quick_attack_rect.height = self.view_rect.height*2
-		
-		#load sounds
+		#Every level gets its own seed, worked out from the game's seed,
+		#the level number and how many times that level has been played.
+		#Play itself draws from self.random, reseeded for each level, so
+		#sounds and other randomness never disturb it.
+		if seed == None:
+			seed = random.getrandbits(32)
+		self.seed = seed
+		self.random = random.Random(seed)
+		self.level_attempts = {}
+		self.recorder = None
+
+		#Frame phase timings, shown over the game with F3
+		self.profiler = FrameProfiler()
+		self.bShowProfile = False
+		self.profile_image = None
+		self.profile_age = 0
+
+		#Levels being made ready ahead of time, keyed by level number: the
+		#future of the layout from the worker process (None when it is laid
+		#out here) and the future of the Level built from it on a thread of
+		#its own.  The worker is started now so it is ready by the time the
+		#opening screen is dismissed.
+		self.level_pool = None
+		self.prefetched_levels = {}
+		if not bHeadless:
+			self._StartLevelPool()
+
+		#Load sounds in the background, the opening sound first since it
+		#is the one needed right away.  A category only shows up in
+		#self.sounds once all of its clips are loaded.
 		self.sounds = {}
-		self.load_sound("opening")
-		self.load_sound("loser")
-		self.load_sound("winner")
-		self.load_sound("door")
-		self.load_sound("enter")
-		self.load_sound("dead_ghost")
-
-		#load pause screens
-		self.opening_img = load_image("opening.bmp")
-		self.loading_img = load_image("loading.bmp")
-		self.winner_img = load_image("winner.bmp")
-		self.loser_img = load_image("loser.bmp")
+		self.pending_sound = None
+		self.sound_thread = threading.Thread(None,self._LoadSounds,"LoadSounds")
+		self.sound_thread.start()
+
+		#Pause screens are loaded the first time they are shown
+		self.pause_images = {}
 
 		#Create Font
 		self.font = pygame.font.Font(os.path.join("data","game_font.ttf"),35)
@@ -689,185 +2007,389 @@ class Game:
 		self.right_cursor = (right_cursor_size,right_cursor_hotspot,tmp[0],tmp[1])
 		tmp = pygame.cursors.compile(center_cursor_strings,'.','X')
 		self.center_cursor = (center_cursor_size,center_cursor_hotspot,tmp[0],tmp[1])
-		pygame.mouse.set_cursor(*self.center_cursor)
+		self._SetCursor(self.center_cursor)
+
+	def _GetPauseImage(self,name):
+		if name not in self.pause_images:
+			self.pause_images[name] = load_image(name+".bmp")
+		return self.pause_images[name]
+
+	def _SetCursor(self,cursor):
+		if not self.bHeadless:
+			pygame.mouse.set_cursor(*cursor)
+
+	def _SetMousePosition(self,pos):
+		if not self.bHeadless:
+			self.mouse_target.SetPosition(pos)
+
+	def _LoadSounds(self):
+		for sound_name in ["opening","loser","winner","door","enter","dead_ghost"]:
+			self.load_sound(sound_name)
 
 	def load_sound(self,sound_name):
 		full_name = os.path.join("data",sound_name)
-		self.sounds[sound_name] = []
+		sounds = []
 		count = 0
 		while True:
 			try:
-				self.sounds[sound_name].append(pygame.mixer.Sound(full_name+str(count)+".wav"))
+				sounds.append(pygame.mixer.Sound(full_name+str(count)+".wav"))
 			except FileNotFoundError:
 				break
 			else:
 				count = count + 1
+		self.sounds[sound_name] = sounds
 
 	def play_sound(self,sound_name):
-		if len(self.sounds[sound_name]) != 0:
-			index = random.randint(0,len(self.sounds[sound_name])-1)
-			self.sounds[sound_name][index].play()
+		sounds = self.sounds.get(sound_name)
+		if sounds == None:
+			#Not loaded yet, so play it once it is (unless something
+			#else is played or stopped first)
+			self.pending_sound = sound_name
+		else:
+			self.pending_sound = None
+			if len(sounds) != 0:
+				index = random.randint(0,len(sounds)-1)
+				sounds[index].play()
+
+	def play_pending_sound(self):
+		if self.pending_sound != None and self.pending_sound in self.sounds:
+			self.play_sound(self.pending_sound)
 
 	def stop_sound(self):
-		sounds = self.sounds
-		for key in sounds.keys():
-			for sound in sounds[key]:
+		self.pending_sound = None
+		for sounds in list(self.sounds.values()):
+			for sound in sounds:
 				sound.stop()
 
+	def _LevelSeed(self,level_num):
+		return "%d:%d:%d" % (self.seed,level_num,self.level_attempts.get(level_num,0))
+
 	def _GenerateLevel(self):
-		maze_width, maze_height, num_ghosts, shaggy_speed, ghost_speed, scooby_speed = self.level_info(self.level)
-		self.shaggy_speed = shaggy_speed
-		self.ghost_speed = ghost_speed
-		self.scooby_speed = scooby_speed
-		self.maze = Maze(maze_width,maze_height,
-							self.max_sprite_width+(2*self.shaggy_speed),
-							self.max_sprite_height+(2*self.shaggy_speed),10)
-		
-		self._GenerateDoors()
-		
-		self._GenerateShaggy()
+		self._InstallLevel(Level(self,LevelLayout(self.level_info,self.level,
+												  self._LevelSeed(self.level))))
+
+	def _InstallLevel(self,level):
+		self.level_attempts[level.level_num] = self.level_attempts.get(level.level_num,0)+1
+		self.random.seed("%s:play" % level.seed)
+		self.dead_ghost = 0
+		self.bConsolidateGhosts = False
+		self.ticks = 0
+		self.near_ghosts = None
+		self.mid_ghosts = []
+		self.profiler.StartLevel(self,level)
+
+		self.shaggy_speed = level.shaggy_speed
+		self.ghost_speed = level.ghost_speed
+		self.scooby_speed = level.scooby_speed
+		self.maze = level.maze
+		self.flow_field = level.flow_field
+
+		self.door_locations = level.door_locations
+		self.door_exits = level.door_exits
+		self.door_pool = level.door_pool
+		self.doorgroup.empty()
+		self.visible_doors = {}
+		self.door_window = None
+		self.target_door_cell = None
+
+		self.shaggy_start = level.shaggy_start
+		self.shaggy.CenterOn(self.maze.GetCellRect(*self.shaggy_start))
+		self.shaggy_hidden = self.clock.now()+1
 		self.shaggygroup.empty()
 		self.shaggygroup.add(self.shaggy)
 
-		self._GenerateScooby()
+		self.scooby = level.scooby
+		self.scooby_id = level.scooby_id
 		self.scoobygroup.empty()
-		self.scoobygroup.add(self.scooby)
-	  
-		self._GenerateGhosts(num_ghosts)
+
+		self.ghosts = level.ghosts
 		self.ghostgroup.empty()
-		self.ghostgroup.add(self.ghosts)
 
 		self.view_rect.center = self.shaggy.GetMazeRect().center
 		self.panx_inc = 0
 		self.pany_inc = 0
 
 		self.mouse_target = MouseTarget(self.view_rect)		
-
-	def _GenerateShaggy(self):
-		index = random.randint(0,len(self.door_locations)-1)
-		self.shaggy_start = self.door_locations[index]
-		self.shaggy.CenterOn(self.maze.GetCellRect(*self.shaggy_start))
-		
-		self.shaggy_hidden = time.time()+1
-		
-	def _GenerateScooby(self):
-		num_cols, num_rows = self.maze.GetCellDimensions()
-		while True:
-			row = random.randint(0,num_rows-1)
-			col = random.randint(0,num_cols-1)
-			if (col,row) in self.door_locations or \
-				abs(self.shaggy_start[0]-col) < int(num_cols/4) or \
-				abs(self.shaggy_start[1]-row) < int(num_rows/4):
-					continue
-			else:
-				self.scooby = MazeObject(demo=self.demo_scooby)
-				self.scooby.CenterOn(self.maze.GetCellRect(col,row))
-				break
-
-	def _GenerateDoors(self):
-		self.door_locations = self.maze.GetDeadEnds()
-		self.door_pool = []
-		rect = pygame.Rect(0,0,self.view_rect.width,self.view_rect.height)
-		c,r,width,height = self.maze.GetCellRange(rect)
-		for x in range((width+1)*(height+1)):
-			self.door_pool.append(MazeObject(demo=self.demo_door))
+		self.bFullRedraw = True
+		if self.recorder != None:
+			self.recorder.StartLevel(self,level)
+
+	def _StartLevelPool(self):
+		#Spawned rather than forked, since this process has a display and
+		#threads of its own.  The pool only starts its worker once it has
+		#work, so it gets an empty job to start it right away.
+		self.level_pool = concurrent.futures.ProcessPoolExecutor(1,
+								multiprocessing.get_context("spawn"))
+		self.level_pool.submit(int)
+
+	def _RequestLevel(self,level_num):
+		#Start making a level ready, unless it already is.  Big levels are
+		#laid out by the level worker process, and every level is built
+		#from its layout on a thread, so the main thread never waits on it.
+		if level_num not in self.prefetched_levels:
+			seed = self._LevelSeed(level_num)
+			num_cols, num_rows = self.level_info(level_num)[:2]
+			layout = None
+			if num_cols*num_rows > LOCAL_LAYOUT_CELLS:
+				try:
+					if self.level_pool == None:
+						self._StartLevelPool()
+					layout = self.level_pool.submit(LevelLayout,self.level_info,level_num,seed)
+				except concurrent.futures.BrokenExecutor:
+					#The worker died, so levels are laid out here from now on
+					layout = None
+			level = concurrent.futures.Future()
+			thread = threading.Thread(None,self._BuildLevel,"BuildLevel",
+									  (level,layout,level_num,seed))
+			thread.daemon = True
+			thread.start()
+			self.prefetched_levels[level_num] = (layout,level)
+
+	def _BuildLevel(self,level,layout,level_num,seed):
+		#Runs on its own thread: wait for the layout from the worker, or
+		#lay the level out here, and build the Level from it
+		if not level.set_running_or_notify_cancel():
+			return
+		try:
+			if layout != None:
+				try:
+					layout = layout.result()
+				except concurrent.futures.CancelledError:
+					raise
+				except Exception:
+					#The worker failed, so lay the level out here instead
+					layout = None
+			if layout == None:
+				layout = LevelLayout(self.level_info,level_num,seed)
+			level.set_result(Level(self,layout))
+		except BaseException as e:
+			level.set_exception(e)
+
+	def _PrefetchLevels(self):
+		#Make the next level and a retry of this one ready in the
+		#background, so either can be swapped in as soon as this one ends
+		level_nums = [self.level+1,self.level]
+		for level_num in list(self.prefetched_levels.keys()):
+			if level_num not in level_nums:
+				layout, level = self.prefetched_levels.pop(level_num)
+				if layout != None:
+					layout.cancel()
+				level.cancel()
+		for level_num in level_nums:
+			self._RequestLevel(level_num)
 
 	def _RefreshDoorGroup(self):
-		cell_col, cell_row, cell_width, cell_height = self.maze.GetCellRange(self.view_rect)
+		#Doors only change in the cells that scrolled into or out of view
 		maze = self.maze
-		self.doorgroup.empty() 
-		index = 0
-		for c in range(cell_width):
-			col = cell_col + c
-			for r in range(cell_height):
-				row = cell_row + r
-				if maze.IsDeadEnd(col,row):
-					target_rect = maze.GetCellRect(col,row)
-					if self.shaggy_hidden and target_rect.colliderect(self.shaggy.GetMazeRect()):
-						self.target_door.CenterOn(target_rect)
-						self.doorgroup.add(self.target_door)
+		visible_doors = self.visible_doors
+		window = maze.GetCellRange(self.view_rect)
+		if window != self.door_window:
+			old_window = self.door_window
+			self.door_window = window
+			if old_window != None:
+				for cell in self._GetDoorCells(old_window,window):
+					door = visible_doors.pop(cell)
+					self.doorgroup.remove(door)
+					if door is self.target_door:
+						self.target_door_cell = None
 					else:
-						self.door_pool[index].CenterOn(target_rect)
-						self.doorgroup.add(self.door_pool[index])
-						index = index + 1
+						self.door_pool.append(door)
+			for cell in self._GetDoorCells(window,old_window):
+				door = self.door_pool.pop()
+				door.CenterOn(maze.GetCellRect(*cell))
+				visible_doors[cell] = door
+				self.doorgroup.add(door)
+
+		#Shaggy hides behind the target door while he is on a door
+		target_cell = None
+		if self.shaggy_hidden:
+			cell = maze.GetCellAt(*self.shaggy.GetMazeRect().center)
+			if cell in visible_doors:
+				target_cell = cell
+		if target_cell != self.target_door_cell:
+			if self.target_door_cell != None:
+				self._SwapDoor(self.target_door_cell,self.door_pool.pop())
+			if target_cell != None:
+				self._SwapDoor(target_cell,self.target_door)
+			self.target_door_cell = target_cell
+
+	def _SwapDoor(self,cell,door):
+		old_door = self.visible_doors[cell]
+		self.doorgroup.remove(old_door)
+		if old_door is not self.target_door:
+			self.door_pool.append(old_door)
+		door.CenterOn(self.maze.GetCellRect(*cell))
+		self.visible_doors[cell] = door
+		self.doorgroup.add(door)
+
+	def _GetDoorCells(self,window,other_window):
+		#Doors inside the window's cell range but outside the other one's
+		retV = []
+		col, row, width, height = window
+		for r in range(row,row+height):
+			spans = [ (col,col+width) ]
+			if other_window != None:
+				other_col, other_row, other_width, other_height = other_window
+				if r >= other_row and r < other_row+other_height:
+					spans = [ (col,min(col+width,other_col)),
+							  (max(col,other_col+other_width),col+width) ]
+			for start_col, end_col in spans:
+				if start_col < end_col:
+					retV.extend(self.maze.GetDeadEndsInRow(r,start_col,end_col))
+		return retV
 
-	def _GenerateGhosts(self,num_ghosts):
-		self.ghosts = []
+	def _ConsolidateGhosts(self):
+		#Ghosts on the same spot have the same center, so they share an
+		#index cell; keep the one with the lowest id.
 		ghosts = self.ghosts
-		ghost_cells = []
-		num_cols, num_rows = self.maze.GetCellDimensions()
-		available_cells = (num_cols*num_rows)-len(self.door_locations)
-		for i in range(num_ghosts):
-			if len(ghost_cells) >= available_cells:
-				break
-			while True:
-				row = random.randint(0,num_rows-1)
-				col = random.randint(0,num_cols-1)
-				if (col,row) in self.door_locations or \
-						(col,row) in ghost_cells:
-					continue
-				else:
-					cell_rect = self.maze.GetCellRect(col,row)
-					new_ghost = MazeObject(demo=self.demo_ghost)
-					new_ghost.CenterOn(cell_rect)
-					ghosts.append(new_ghost)
-					ghost_cells.append( (col,row) )
+		kept = set()
+		for ghost in ghosts:
+			center = ghosts.GetPosition(ghost)
+			for other in ghosts.GetInCell(*ghosts.GetCell(ghost)):
+				if other in kept and ghosts.GetPosition(other) == center:
+					ghosts.Remove(ghost)
 					break
-
-	def _ConsolidateGhosts(self):
-		i = 0
-		j = 0
+			else:
+				kept.add(ghost)
+		self.near_ghosts = None
+
+	def _SortGhostTiers(self):
+		#Sort the chasing ghosts by how far they are from Shaggy along the
+		#maze.  Ghosts near him or close to the view move every tick, mid
+		#range ones every GHOST_TIER_TICKS ticks (by that many ticks'
+		#worth) and the rest sleep.  Sorted again every GHOST_TIER_TICKS
+		#ticks and whenever ghosts come or go.
+		maze = self.maze
 		ghosts = self.ghosts
-		while i < len(ghosts):
-			j = i + 1
-			while j < len(ghosts):
-				if ghosts[i].GetMazeRect().center == ghosts[j].GetMazeRect().center:
-					self.ghostgroup.remove(ghosts[j])
-					del ghosts[j]
-				else:
-					j = j + 1
-			i = i + 1
-
-	def _RunFrame(self):
-		retV = self.PLAYING
+		get_distance = self.flow_field.GetDistance
+		total_cell_width = maze.total_cell_width
+		total_cell_height = maze.total_cell_height
+		view_rect = self.view_rect.inflate(total_cell_width*2,total_cell_height*2)
+		target_ghosts = ghosts.tags["targeted"]
+		#Only ghosts within GHOST_FAR_CELLS cells (as the crow flies) of
+		#Shaggy or close to the view can be awake
+		col, row = self.flow_field.GetRoot()
+		far_rect = pygame.Rect((col-GHOST_FAR_CELLS)*total_cell_width,
+							   (row-GHOST_FAR_CELLS)*total_cell_height,
+							   (2*GHOST_FAR_CELLS+1)*total_cell_width,
+							   (2*GHOST_FAR_CELLS+1)*total_cell_height)
+		candidates = set(ghosts.GetColliding(far_rect))
+		candidates.update(ghosts.GetColliding(view_rect))
+		near = []
+		mid = []
+		for ghost in sorted(candidates):
+			if ghost in target_ghosts:
+				continue
+			distance = get_distance(*ghosts.GetCell(ghost))
+			if distance <= GHOST_NEAR_CELLS or view_rect.colliderect(ghosts.GetMazeRect(ghost)):
+				near.append(ghost)
+			elif distance <= GHOST_FAR_CELLS:
+				mid.append(ghost)
+		self.near_ghosts = near
+		self.mid_ghosts = mid
+
+	def _ChaseShaggy(self,entities,ids,speed):
+		#Move the given entities one step toward Shaggy (or away from him
+		#with a negative speed) along the maze's flow field, in one pass.
+		#An entity heads for the center of the next cell on its path, and
+		#only goes straight for Shaggy once it is in his cell.  Each
+		#move goes straight to the maze's slide query on plain
+		#coordinates, and entities that would not move are skipped.
+		if speed == 0:
+			return
+		maze = self.maze
+		flow_field = self.flow_field
+		get_next_cell = flow_field.GetNextCell
+		get_cell_center = maze.GetCellCenter
+		get_slide_distance = maze.GetSlideDistance
+		total_cell_width = maze.total_cell_width
+		total_cell_height = maze.total_cell_height
+		root = flow_field.GetRoot()
+		bFlee = speed < 0
+		speed = abs(speed)
+		neg_speed = 0-speed
+		s_xpos, s_ypos = self.shaggy.GetPosition()
+		lefts = entities.left
+		tops = entities.top
+		slots = entities.slot
+		sizes = entities.sizes
+		for id in ids:
+			cell = entities.GetCell(id)
+			width, height = sizes[slots[id]]
+			x_pos = lefts[id]+width//2
+			y_pos = tops[id]+height//2
+			if bFlee:
+				next_cell = get_next_cell(cell[0],cell[1],True)
+				if next_cell == None:
+					continue
+				t_xpos, t_ypos = get_cell_center(*next_cell)
+			elif cell == root:
+				t_xpos, t_ypos = s_xpos, s_ypos
+			else:
+				next_cell = get_next_cell(cell[0],cell[1])
+				if next_cell == None:
+					#Out of reach of a bounded flow field
+					continue
+				t_xpos, t_ypos = get_cell_center(*next_cell)
+			x_offset = t_xpos - x_pos
+			y_offset = t_ypos - y_pos
+			if x_offset > speed:
+				x_offset = speed
+			elif x_offset < neg_speed:
+				x_offset = neg_speed
+			if y_offset > speed:
+				y_offset = speed
+			elif y_offset < neg_speed:
+				y_offset = neg_speed
+			if x_offset == 0 and y_offset == 0:
+				continue
+			entities.Face(id,x_offset,y_offset)
+			left = lefts[id]
+			top = tops[id]
+			width, height = sizes[slots[id]]
+			if x_offset != 0:
+				left = left + get_slide_distance(left,top,left+width,top+height,x_offset)
+			if y_offset != 0:
+				top = top + get_slide_distance(left,top,left+width,top+height,y_offset,True)
+			entities.SetPosition(id,left,top)
+
+	def _ReadInput(self):
+		#Poll one frame's worth of events and controls.  Returns
+		#(bQuit, bUseDoor, bToggleMouse, x_offset, y_offset, mouse_pos),
+		#which is everything from the player _RunFrame acts on, so
+		#recorded input can be fed back in its place.
+		bQuit = False
 		bUseDoor = False
+		bToggleMouse = False
+		bUseMouse = self.bUseMouse
 		for event in pygame.event.get():
 			if event.type == QUIT:
-				retV = self.QUIT
+				bQuit = True
 			elif event.type == KEYDOWN and event.key == K_ESCAPE:
-				retV = self.QUIT
+				bQuit = True
 			elif event.type == KEYDOWN and event.key == K_SPACE:
 				bUseDoor = True
 			elif event.type == JOYBUTTONDOWN:
 				bUseDoor = True
 			elif event.type == KEYDOWN and event.key == K_m:
-				if self.bUseMouse:
-					self.bUseMouse = False
-					pygame.mouse.set_cursor(*self.center_cursor)
-				else:
-					self.bUseMouse = True
-					self.mouse_target.SetPosition(self.shaggy.GetMazeRect().center)
-			elif self.bUseMouse and event.type == MOUSEBUTTONDOWN:
+				bToggleMouse = not bToggleMouse
+				bUseMouse = not bUseMouse
+			elif bUseMouse and event.type == MOUSEBUTTONDOWN:
 				bUseDoor = True
-		
-		#Handle Shaggy's movement
+			elif event.type == VIDEOEXPOSE:
+				self.bFullRedraw = True
+			elif event.type == KEYDOWN and event.key == K_F3:
+				self.bShowProfile = not self.bShowProfile
+
 		x_offset = 0
 		y_offset = 0
-		if self.bUseMouse:
-			if not self.shaggy_hidden:
-				self.shaggy.Attack(self.maze,self.mouse_target,self.shaggy_speed)
-				if self.mouse_target.GetPosition() == self.shaggy.GetMazeRect().center:
-					pygame.mouse.set_cursor(*self.center_cursor)
-				else:
-					dir = self.shaggy.GetDirection()
-					if dir == self.shaggy.D_UP:
-						pygame.mouse.set_cursor(*self.up_cursor)
-					elif dir == self.shaggy.D_DOWN:
-						pygame.mouse.set_cursor(*self.down_cursor)
-					elif dir == self.shaggy.D_LEFT:
-						pygame.mouse.set_cursor(*self.left_cursor)
-					elif dir == self.shaggy.D_RIGHT:
-						pygame.mouse.set_cursor(*self.right_cursor)
+		mouse_pos = None
+		if bUseMouse:
+			if bToggleMouse:
+				#The mouse is about to be put on Shaggy
+				mouse_pos = self.shaggy.GetMazeRect().center
+			else:
+				mouse_pos = self.mouse_target.GetPosition()
 		else:
 			if self.joystick != None:
 				x_offset = int(round(self.shaggy_speed*self.joystick.get_axis(0)))
@@ -882,8 +2404,48 @@ class Game:
 					x_offset = x_offset + self.shaggy_speed
 				if keys[K_LEFT]:
 					x_offset = x_offset - self.shaggy_speed
+		return (bQuit,bUseDoor,bToggleMouse,x_offset,y_offset,mouse_pos)
+
+	def _RunFrame(self,frame_input=None):
+		#One tick of game logic
+		retV = self.PLAYING
+		profiler = self.profiler
+		if frame_input == None:
+			frame_input = self._ReadInput()
+		if self.recorder != None:
+			self.recorder.RecordFrame(frame_input,self.clock)
+		profiler.Mark("input")
+		bQuit, bUseDoor, bToggleMouse, x_offset, y_offset, mouse_pos = frame_input
+		if bQuit:
+			retV = self.QUIT
+		if bToggleMouse:
+			if self.bUseMouse:
+				self.bUseMouse = False
+				self._SetCursor(self.center_cursor)
+			else:
+				self.bUseMouse = True
+				self._SetMousePosition(self.shaggy.GetMazeRect().center)
+		
+		#Handle Shaggy's movement
+		if self.bUseMouse:
+			if not self.shaggy_hidden:
+				self.shaggy.Attack(self.maze,FixedTarget(mouse_pos),self.shaggy_speed)
+				if mouse_pos == self.shaggy.GetMazeRect().center:
+					self._SetCursor(self.center_cursor)
+				else:
+					dir = self.shaggy.GetDirection()
+					if dir == self.shaggy.D_UP:
+						self._SetCursor(self.up_cursor)
+					elif dir == self.shaggy.D_DOWN:
+						self._SetCursor(self.down_cursor)
+					elif dir == self.shaggy.D_LEFT:
+						self._SetCursor(self.left_cursor)
+					elif dir == self.shaggy.D_RIGHT:
+						self._SetCursor(self.right_cursor)
+		else:
 			if not self.shaggy_hidden:
 				self.shaggy.Move(self.maze,x_offset,y_offset)
+		profiler.Mark("shaggy")
 
 		#Refresh the sprites and display considering the recent movement.
 		shaggy_rect = self.shaggy.GetMazeRect()
@@ -918,170 +2480,96 @@ class Game:
 				view_rect.top = maze_rect.top
 			elif view_rect.bottom > maze_rect.bottom:
 				view_rect.bottom = maze_rect.bottom
+		profiler.Mark("camera")
 
 		#Let the ghost give chase
 		ghost_speed = self.ghost_speed
 		if self.shaggy_hidden:
 			ghost_speed = 0-ghost_speed
-		quick_attack = False
-		if self.clock.get_time() > 1000.0/float(FRAMES_PER_SECOND):
-			quick_attack = True
-			self.quick_attack_rect.left = view_rect.left-view_rect.width
-			self.quick_attack_rect.top  = view_rect.top-view_rect.height
-
-		for ghost in self.ghosts:
-			if ghost not in self.target_ghosts:
-				if quick_attack:
-					if ghost.GetMazeRect().colliderect(self.quick_attack_rect):
-						ghost.Attack(self.maze,self.shaggy,ghost_speed)
-				else:
-					ghost.Attack(self.maze,self.shaggy,ghost_speed)
-			else:
-				ghost.Attack(self.maze,self.shaggy,self.ghost_speed)
-		self.scooby.Attack(self.maze,self.shaggy,self.scooby_speed)
+		self.flow_field.SetRoot(*self.maze.GetCellAt(*self.shaggy.GetPosition()))
+		tier_tick = self.ticks%GHOST_TIER_TICKS
+		if tier_tick == 0 or self.near_ghosts == None:
+			self._SortGhostTiers()
+		self.ticks = self.ticks+1
+		ghosts = self.ghosts
+		self._ChaseShaggy(ghosts,self.near_ghosts,ghost_speed)
+		self._ChaseShaggy(ghosts,self.mid_ghosts[tier_tick::GHOST_TIER_TICKS],
+						  ghost_speed*GHOST_TIER_TICKS)
+		self._ChaseShaggy(ghosts,ghosts.GetTagged("targeted"),self.ghost_speed)
+		self._ChaseShaggy(self.scooby,[self.scooby_id],self.scooby_speed)
+		profiler.Mark("ghosts")
 
 		self._RefreshDoorGroup()
 		self.doorgroup.update(view_rect)
-		self.ghostgroup.update(view_rect)
-		self.scoobygroup.update(view_rect)
+		profiler.Mark("doors")
+
+		ghosts.UpdateSprites(self.ghostgroup,view_rect)
+		self.scooby.UpdateSprites(self.scoobygroup,view_rect)
 		self.shaggygroup.update(view_rect)
 		self.banggroup.update(view_rect)
-
-		self.screen.blit(self.background,(0,0))
-		self.maze.Draw(self.screen,view_rect)
-		self.doorgroup.draw(self.screen)
-		self.ghostgroup.draw(self.screen)
-		self.scoobygroup.draw(self.screen)
-		if not self.shaggy_hidden:
-			self.shaggygroup.draw(self.screen)
-		if self.dead_ghost:
-			self.banggroup.draw(self.screen)
-		pygame.display.flip()
+		profiler.Mark("sprite_update")
 
 		if self.dead_ghost:
 			if self.bUseMouse:
-				self.mouse_target.SetPosition(self.shaggy.GetMazeRect().center)
-				pygame.mouse.set_cursor(*self.center_cursor)
+				self._SetMousePosition(self.shaggy.GetMazeRect().center)
+				self._SetCursor(self.center_cursor)
 			if self.bConsolidateGhosts:
 				self._ConsolidateGhosts()
 				self.bConsolidateGhosts = False
-			if time.time() >= self.dead_ghost:
+			if self.clock.now() >= self.dead_ghost:
 				self.dead_ghost = 0
 				self.shaggy_hidden = 0
-				self.target_ghosts = []
+				ghosts.ClearTag("targeted")
 		elif self.shaggy_hidden:
 			if self.bUseMouse:
-				self.mouse_target.SetPosition(self.shaggy.GetMazeRect().center)
-				pygame.mouse.set_cursor(*self.center_cursor)
-			if time.time() >= self.shaggy_hidden:
+				self._SetMousePosition(self.shaggy.GetMazeRect().center)
+				self._SetCursor(self.center_cursor)
+			if self.clock.now() >= self.shaggy_hidden:
 				self.shaggy_hidden = 0
 				self.panx_inc = 0
 				self.pany_inc = 0
 				
-				if len(self.target_ghosts) > 0:				
+				if len(ghosts.tags["targeted"]) > 0:
 					self.play_sound("dead_ghost")
-					self.dead_ghost = time.time()+1
+					self.dead_ghost = self.clock.now()+1
 					self.shaggy_hidden = 1
 					self.bang.CenterOn(self.shaggy.GetMazeRect())
-					for ghost in self.target_ghosts:
-						self.ghostgroup.remove(ghost)
-						del self.ghosts[self.ghosts.index(ghost)]
+					for ghost in ghosts.GetTagged("targeted"):
+						ghosts.Remove(ghost)
+					self.near_ghosts = None
 					self.bConsolidateGhosts = True
 		else:
 			#Check for relevant collisions
-			if pygame.sprite.spritecollideany( self.shaggy, self.ghostgroup ) != None:
+			if ghosts.Collide(self.shaggy.GetMazeRect()) != None:
 				retV = self.LOSER_PLAY
-				pygame.mouse.set_cursor(*self.center_cursor)
-			elif pygame.sprite.spritecollideany( self.shaggy, self.scoobygroup ) != None:
+				self._SetCursor(self.center_cursor)
+			elif self.scooby.Collide(self.shaggy.GetMazeRect()) != None:
 				retV = self.WINNER_PLAY
-				pygame.mouse.set_cursor(*self.center_cursor)
+				self._SetCursor(self.center_cursor)
 			elif bUseDoor:
 				door = pygame.sprite.spritecollideany( self.shaggy, self.doorgroup )
 				if door != None:
 					current_col,current_row,w,h = self.maze.GetCellRange(door.GetMazeRect())
-					num_cols, num_rows = self.maze.GetCellDimensions()
-					direction = self.shaggy.GetDirection()
-					b_less_than_first = random.randint(0,1)
-					target = None
-					if direction == self.shaggy.D_UP or direction == self.shaggy.D_DOWN:
-						if b_less_than_first:
-							col_list = [current_col,current_col-1,current_col+1]
-						else:
-							col_list = [current_col,current_col+1,current_col-1]
-						if direction == self.shaggy.D_UP:
-							adder = -1
-						else:
-							adder = 1
-						r = current_row + adder
-						while True:
-							if r < 0:
-								r = num_rows
-							elif r >= num_rows:
-								r = -1
-							else:
-								for c in col_list:
-									if c < 0 or c >= num_cols:
-										continue
-									elif c == current_col and r == current_row:
-										continue
-									else:
-										if self.maze.IsDeadEnd(c,r):
-											target = (c,r)
-											break
-							if target != None:
-								break
-							elif r == current_row:
-								break
-							else:
-								r = r + adder
-					else:
-						if b_less_than_first:
-							row_list = [current_row, current_row-1, current_row+1]
-						else:
-							row_list = [current_row, current_row+1, current_row-1]
-						if direction == self.shaggy.D_LEFT:
-							adder = -1
-						else:
-							adder = 1
-						c = current_col + adder
-						while True:
-							if c < 0:
-								c = num_cols
-							elif c >= num_cols:
-								c = -1
-							else:
-								for r in row_list:
-									if r < 0 or r >= num_rows:
-										continue
-									elif c == current_col and r == current_row:
-										continue
-									else:
-										if self.maze.IsDeadEnd(c,r):
-											target = (c,r)
-											break
-							if target != None:
-								break
-							elif c == current_col:
-								break
-							else:
-								c = c + adder
+					door_locations, door_index, exits = self._GetDoorExits(current_col,current_row)
+					b_less_than_first = self.random.randint(0,1)
+					target = exits[(self.shaggy.GetDirection()*2)+b_less_than_first]
 					if target == None:
-						while True:
-							index = random.randint(0,len(self.door_locations)-1)
-							c, r = self.door_locations[index]
-							if c == current_col and r == current_row:
-								continue
-							else:
-								target = (c,r)
-								break		  
+						#Nothing ahead, so go to any other door
+						if len(door_locations) > 1:
+							index = self.random.randint(0,len(door_locations)-2)
+							if index >= door_index:
+								index = index + 1
+							target = door_locations[index]
+						else:
+							target = (current_col,current_row)
 					target_maze_rect = self.maze.GetCellRect(*target)
 					self.shaggy.CenterOn(target_maze_rect)
 					self.play_sound("door")
-					self.shaggy_hidden = time.time()+1
+					self.shaggy_hidden = self.clock.now()+1
 
-					for ghost in self.ghosts:
-						if target_maze_rect.colliderect(ghost.GetMazeRect()):
-							self.target_ghosts.append(ghost)
+					for ghost in ghosts.GetColliding(target_maze_rect):
+						ghosts.Tag(ghost,"targeted")
+					self.near_ghosts = None
 
 					pan_step = int(self.clock.get_fps()/2)
 					
@@ -1099,8 +2587,123 @@ class Game:
 						self.pany_inc = 1
 					else:
 						self.pany_inc =  int(self.pany_inc/pan_step)
+		profiler.Mark("rules")
+		if retV != self.PLAYING:
+			profiler.EndLevel(retV)
+			if self.recorder != None:
+				self.recorder.EndLevel(retV,self._Fingerprint())
 		return retV
 
+	def _GetDoorExits(self,col,row):
+		#Where the door in the given cell leads: the doors it can lead to,
+		#its index among them and its exits (see LevelLayout.FindDoorExits).
+		#A streamed maze has no door list, so only the doors within
+		#DOOR_SEARCH_ROWS rows are searched, without wrapping top to bottom.
+		if self.door_exits != None:
+			door_index, exits = self.door_exits[(col,row)]
+			return self.door_locations, door_index, exits
+		maze = self.maze
+		door_locations = []
+		for r in range(max(0,row-DOOR_SEARCH_ROWS),min(maze.num_rows,row+DOOR_SEARCH_ROWS+1)):
+			door_locations.extend(maze.GetDeadEndsInRow(r,0,maze.num_cols))
+		doors_by_col = {}
+		doors_by_row = {}
+		for c, r in door_locations:
+			doors_by_col.setdefault(c,[]).append(r)
+			doors_by_row.setdefault(r,[]).append(c)
+		exits = LevelLayout.FindDoorExits(doors_by_col,doors_by_row,col,row,
+										  maze.num_cols,maze.num_rows,False)
+		return door_locations, door_locations.index((col,row)), exits
+
+	def _Fingerprint(self):
+		#A cheap summary of where everything is, to compare replays by
+		ghosts = self.ghosts
+		return [ list(self.shaggy.GetMazeRect().topleft),
+				 list(self.scooby.GetMazeRect(self.scooby_id).topleft),
+				 len(ghosts),
+				 sum([ ghosts.left[ghost] for ghost in ghosts ]),
+				 sum([ ghosts.top[ghost] for ghost in ghosts ]) ]
+
+	def _DrawFrame(self):
+		view_rect = self.view_rect
+		screen = self.screen
+		profiler = self.profiler
+		if not self.bDirtyRects or self.bFullRedraw or \
+		   self.last_view_topleft != view_rect.topleft:
+			screen.blit(self.background,(0,0))
+			self.maze.Draw(screen,view_rect)
+			profiler.Mark("maze_draw")
+			self.drawn_rects = self._DrawSprites()
+			profiler.Mark("sprites")
+			self.drawn_rects.extend(self._DrawProfile())
+			profiler.Mark("overlay")
+			pygame.display.flip()
+			profiler.Mark("flip")
+			self.last_view_topleft = view_rect.topleft
+			self.bFullRedraw = False
+			return
+
+		#The view has not moved, so only the areas the sprites covered
+		#last frame and cover this frame need to be drawn and pushed.
+		old_rects = self.drawn_rects
+		for rect in old_rects:
+			screen.blit(self.background,rect,rect)
+			self.maze.Draw(screen.subsurface(rect),rect.move(view_rect.topleft))
+		profiler.Mark("maze_draw")
+		self.drawn_rects = self._DrawSprites()
+		profiler.Mark("sprites")
+		self.drawn_rects.extend(self._DrawProfile())
+		profiler.Mark("overlay")
+		pygame.display.update(old_rects+self.drawn_rects)
+		profiler.Mark("flip")
+
+	def _DrawProfile(self):
+		#Draw the phase timings over the top left of the screen when they
+		#are turned on and return the screen area they cover.  Rendering
+		#the text is slow next to everything else, so it is only redone a
+		#few times a second.
+		if not self.bShowProfile:
+			self.profile_image = None
+			return []
+		self.profile_age = self.profile_age-1
+		if self.profile_image == None or self.profile_age <= 0:
+			self.profile_image = self._RenderProfile()
+			self.profile_age = int(FRAMES_PER_SECOND/4)
+		return [self.screen.blit(self.profile_image,(0,0)).clip(self.screen.get_rect())]
+
+	def _RenderProfile(self):
+		font = self.legal_font
+		color = pygame.color.Color('0x00ff00')
+		rows = [ ["ms","p50","p95","p99"] ]
+		for phase in self.profiler.PHASES+["frame"]:
+			rows.append([phase]+[ "%.2f" % ms for ms in self.profiler.GetPercentiles(phase,[50,95,99]) ])
+		line_height = font.get_linesize()
+		column_width = font.size("sprite_update ")[0]
+		image = pygame.Surface((column_width*4+8,line_height*len(rows)+8))
+		for i in range(len(rows)):
+			for j in range(len(rows[i])):
+				image.blit(font.render(rows[i][j],1,color),(4+j*column_width,4+i*line_height))
+		return image
+
+	def _DrawSprites(self):
+		#Draw the sprites and return the (clipped) screen areas they cover
+		groups = [self.doorgroup,self.ghostgroup,self.scoobygroup]
+		if not self.shaggy_hidden:
+			groups.append(self.shaggygroup)
+		if self.dead_ghost:
+			groups.append(self.banggroup)
+		screen_rect = self.screen.get_rect()
+		rects = []
+		for group in groups:
+			if self.bDirtyRects:
+				for sprite in group:
+					rect = self.screen.blit(sprite.image,sprite.rect).clip(screen_rect)
+					if rect.width and rect.height:
+						rects.append(rect)
+			else:
+				group.draw(self.screen)
+		return rects
+
 	def _ShowOpening(self):
 		retV = self.OPENING
 		for event in pygame.event.get():
@@ -1121,9 +2724,10 @@ class Game:
 					self.bUseMouse = True
 				
 		view_width, view_height = self.screen.get_size()
-		opening_width, opening_height = self.opening_img.get_size()
+		opening_img = self._GetPauseImage("opening")
+		opening_width, opening_height = opening_img.get_size()
 		self.screen.blit(self.background,(0,0))
-		self.screen.blit(self.opening_img,( int((view_width-opening_width)/2), int((view_height-opening_height)/2) ))
+		self.screen.blit(opening_img,( int((view_width-opening_width)/2), int((view_height-opening_height)/2) ))
 
 		copyright_text = self.legal_font.render("Game Engine Copyright (c) 2005 Dan Tabor. All rights reserved.",1,pygame.color.Color('0xff0000'))
 		img_width, img_height = copyright_text.get_size()
@@ -1160,9 +2764,10 @@ class Game:
 					self.bUseMouse = True
 				
 		view_width, view_height = self.screen.get_size()
-		img_width, img_height = self.winner_img.get_size()
+		winner_img = self._GetPauseImage("winner")
+		img_width, img_height = winner_img.get_size()
 		self.screen.blit(self.background,(0,0))
-		self.screen.blit(self.winner_img,( int((view_width-img_width)/2), int((view_height-img_height)/2) ))
+		self.screen.blit(winner_img,( int((view_width-img_width)/2), int((view_height-img_height)/2) ))
 
 		text = self.font.render("Press button to enter level %d" % int(self.level),1,pygame.color.Color('0xff0000'))
 		img_width, img_height = text.get_size()
@@ -1185,9 +2790,10 @@ class Game:
 					self.bUseMouse = True
 				
 		view_width, view_height = self.screen.get_size()
-		img_width, img_height = self.loading_img.get_size()
+		loading_img = self._GetPauseImage("loading")
+		img_width, img_height = loading_img.get_size()
 		self.screen.blit(self.background,(0,0))
-		self.screen.blit(self.loading_img,( int((view_width-img_width)/2), int((view_height-img_height)/2) ))
+		self.screen.blit(loading_img,( int((view_width-img_width)/2), int((view_height-img_height)/2) ))
 
 		text = self.font.render("Loading level %d..." % int(self.level),1,pygame.color.Color('0xff0000'))
 		img_width, img_height = text.get_size()
@@ -1216,9 +2822,10 @@ class Game:
 					self.bUseMouse = True
 				
 		view_width, view_height = self.screen.get_size()
-		img_width, img_height = self.loser_img.get_size()
+		loser_img = self._GetPauseImage("loser")
+		img_width, img_height = loser_img.get_size()
 		self.screen.blit(self.background,(0,0))
-		self.screen.blit(self.loser_img,( int((view_width-img_width)/2), int((view_height-img_height)/2) ))
+		self.screen.blit(loser_img,( int((view_width-img_width)/2), int((view_height-img_height)/2) ))
 
 		text = self.font.render("Press button to retry level %d" % int(self.level),1,pygame.color.Color('0xff0000'))
 		img_width, img_height = text.get_size()
@@ -1227,28 +2834,69 @@ class Game:
 		pygame.display.flip()
 		return retV
 
+	def _PlayFrame(self):
+		#Run as many ticks as the time since the last frame calls for and
+		#draw the result once.  A slow machine drops frames, not ticks.
+		tick_time = 1.0/float(TICKS_PER_SECOND)
+		state = self.PLAYING
+		ticks = 0
+		self.profiler.StartFrame()
+		while self.tick_lag >= tick_time and state == self.PLAYING:
+			if ticks == MAX_TICKS_PER_FRAME:
+				#Too far behind to catch up
+				self.tick_lag = 0.0
+				break
+			self.clock.tick()
+			state = self._RunFrame()
+			self.tick_lag = self.tick_lag-tick_time
+			ticks = ticks + 1
+		if ticks > 0:
+			if state == self.PLAYING:
+				self._DrawFrame()
+			self.profiler.EndFrame()
+		return state
+
 	def Run(self):
-		load_thread = None
 		state = self.OPENING_PLAY
 		
 		while 1:
-			self.clock.tick(int(FRAMES_PER_SECOND))
+			frame_time = self.frame_clock.tick(int(FRAMES_PER_SECOND))/1000.0
+			self.play_pending_sound()
 			if state == self.OPENING_PLAY:
 				self.play_sound("opening")
 				state = self._ShowOpening()
 			elif state == self.OPENING:
 				state = self._ShowOpening()
 			elif state == self.LOADING:
-				if load_thread == None:
-					load_thread = threading.Thread(None,self._GenerateLevel,"GenerateLevel")
-					load_thread.start()
-				state = self._ShowLoading()
+				#The level is made ready off the main thread, so the
+				#loading screen keeps going while it waits
+				self._RequestLevel(self.level)
+				layout, level = self.prefetched_levels[self.level]
+				if level.done():
+					del self.prefetched_levels[self.level]
+					try:
+						level = level.result()
+					except Exception:
+						#Building it failed, so build it here instead
+						level = Level(self,LevelLayout(self.level_info,self.level,
+													   self._LevelSeed(self.level)))
+					self._InstallLevel(level)
+					state = self.PLAYING_PLAY
+				else:
+					state = self._ShowLoading()
 			elif state == self.PLAYING_PLAY:
+				self._PrefetchLevels()
 				self.stop_sound()
 				self.play_sound("enter")
-				state = self._RunFrame()
+				self.tick_lag = 1.0/float(TICKS_PER_SECOND)
+				state = self._PlayFrame()
 			elif state == self.PLAYING:
-				state = self._RunFrame()
+				tick_time = 1.0/float(TICKS_PER_SECOND)
+				ticks = round(frame_time/tick_time)
+				if abs(frame_time-ticks*tick_time) < TICK_SNAP:
+					frame_time = ticks*tick_time
+				self.tick_lag = self.tick_lag+frame_time
+				state = self._PlayFrame()
 			elif state == self.LOSER_PLAY:
 				self.stop_sound()
 				self.play_sound("loser")
@@ -1264,11 +2912,65 @@ class Game:
 				state = self._ShowWinner()
 			else:
 				break
-			   
-			if load_thread != None:
-				if not load_thread.is_alive():
-					load_thread = None
-					state = self.PLAYING_PLAY
+
+		if self.level_pool != None:
+			self.level_pool.shutdown(False,cancel_futures=True)
+			
+	def Simulate(self,num_frames):
+		#Play num_frames frames of game logic headless and as fast as
+		#possible, moving straight on to the next level (or a retry)
+		#whenever a level ends.  Returns the number of levels finished.
+		levels = 0
+		self._GenerateLevel()
+		for i in range(num_frames):
+			self.clock.tick()
+			self.profiler.StartFrame()
+			state = self._RunFrame()
+			self.profiler.EndFrame()
+			if state == self.QUIT:
+				break
+			elif state == self.WINNER_PLAY:
+				self.level = self.level+1
+			if state != self.PLAYING:
+				levels = levels + 1
+				self._GenerateLevel()
+		return levels
+
+	def Replay(self,session):
+		#Play a recorded session back headless and as fast as possible.
+		#Returns the number of frames played and the levels that did not
+		#end the way they did when they were recorded.
+		facing = { MazeObject.D_UP    : (0,-1),
+				   MazeObject.D_DOWN  : (0,1),
+				   MazeObject.D_LEFT  : (-1,0),
+				   MazeObject.D_RIGHT : (1,0) }
+		clock = ReplayClock()
+		self.clock = clock
+		num_frames = 0
+		mismatches = []
+		for record in session["levels"]:
+			self.level = record["level"]
+			self.bUseMouse = record["use_mouse"]
+			if record["direction"] in facing:
+				self.shaggy.Face(*facing[record["direction"]])
+			clock.SetFrame(record["start"],0,0.0)
+			self._InstallLevel(Level(self,LevelLayout(self.level_info,self.level,record["seed"])))
+			state = self.PLAYING
+			for frame in record["frames"]:
+				bQuit, bUseDoor, bToggleMouse, x_offset, y_offset, mouse_x, mouse_y, now, frame_time, fps = frame
+				mouse_pos = None
+				if mouse_x != None:
+					mouse_pos = (mouse_x,mouse_y)
+				clock.SetFrame(now,frame_time,fps)
+				self.profiler.StartFrame()
+				state = self._RunFrame( (bool(bQuit),bool(bUseDoor),bool(bToggleMouse),
+										 x_offset,y_offset,mouse_pos) )
+				self.profiler.EndFrame()
+				num_frames = num_frames + 1
+			if "result" in record:
+				if state != record["result"] or self._Fingerprint() != record["fingerprint"]:
+					mismatches.append(record["level"])
+		return num_frames, mismatches
 			
 def parent_level_info(level_num):
 	shaggy_speed = 10
@@ -1283,18 +2985,53 @@ def parent_level_info(level_num):
 	return (maze_width, maze_height, num_ghosts,
 			shaggy_speed, ghost_speed, scooby_speed)
 
+def marathon_level_info(level_num):
+	#A narrow maze a hundred thousand rows long per level, far too big to
+	#generate up front, so it is streamed (see Maze.STREAM_CELLS)
+	shaggy_speed = 5 + int(level_num/20)
+	ghost_speed =  2 + ( 2 * int(level_num/20) )
+	scooby_speed = 0 - int(level_num/30)
+
+	maze_width = 12
+	maze_height = 100000*level_num
+
+	num_ghosts = int(maze_width*maze_height/64)
+
+	return (maze_width, maze_height, num_ghosts,
+			shaggy_speed, ghost_speed, scooby_speed)
+
+#Level info functions by name, for recorded sessions
+LEVEL_INFOS = { "_default_level_info" : _default_level_info,
+				"parent_level_info"   : parent_level_info,
+				"marathon_level_info" : marathon_level_info }
+
 def usage():
 	print("Usage:")
-	print("   scooby_maze.py [-h] [-p] [-l level]")
+	print("   scooby_maze.py [-h] [-p] [-m] [-d] [-a] [-l level] [-s frames] [-w file] [-r file] [-t file]")
 	print("")
 	print("h - Show this message")
 	print("p - Parent Mode (much harder)")
+	print("m - Marathon Mode (a maze too long to see the end of)")
+	print("d - Only redraw changed areas when the view is still")
+	print("a - Build the asset pack for this display and exit")
 	print("l - Start at specified level")
+	print("s - Simulate the given number of frames headless and exit")
+	print("w - Record the session to a file")
+	print("r - Replay a recorded session headless, check it and exit")
+	print("t - Append per level frame timings to a file as JSON lines")
+	print("")
+	print("F3 shows the frame timings while playing")
 	sys.exit(1)
 	
 def main():
 	level_info = _default_level_info
 	start_level = 1
+	bDirtyRects = False
+	num_frames = None
+	bBuildAssets = False
+	record_file = None
+	replay_file = None
+	profile_file = None
 	i = 1
 	if len(sys.argv) > 1:
 		while i < len( sys.argv ):
@@ -1302,6 +3039,12 @@ def main():
 				usage()
 			elif sys.argv[i] == "-p":
 				level_info = parent_level_info
+			elif sys.argv[i] == "-m":
+				level_info = marathon_level_info
+			elif sys.argv[i] == "-d":
+				bDirtyRects = True
+			elif sys.argv[i] == "-a":
+				bBuildAssets = True
 			elif sys.argv[i] == "-l" and len(sys.argv) > i+1:
 				try:
 					start_level = int(sys.argv[i+1])
@@ -1309,11 +3052,66 @@ def main():
 					usage()
 				else:
 					i = i + 1
+			elif sys.argv[i] == "-w" and len(sys.argv) > i+1:
+				record_file = sys.argv[i+1]
+				i = i + 1
+			elif sys.argv[i] == "-r" and len(sys.argv) > i+1:
+				replay_file = sys.argv[i+1]
+				i = i + 1
+			elif sys.argv[i] == "-t" and len(sys.argv) > i+1:
+				profile_file = sys.argv[i+1]
+				i = i + 1
+			elif sys.argv[i] == "-s" and len(sys.argv) > i+1:
+				try:
+					num_frames = int(sys.argv[i+1])
+				except Exception:
+					usage()
+				else:
+					i = i + 1
 			else:
 				usage()
 			i = i + 1
-	obj = Game(level_info,start_level=start_level)
+	if bBuildAssets:
+		obj = Game(level_info,start_level=start_level)
+		count = asset_pack.Save()
+		print("Packed %d images into %s" % (count,ASSET_PACK))
+		return
+	if num_frames != None:
+		obj = Game(level_info,start_level=start_level,bHeadless=True)
+		if profile_file != None:
+			obj.profiler.log = open(profile_file,"a")
+		start = time.perf_counter()
+		levels = obj.Simulate(num_frames)
+		elapsed = time.perf_counter()-start
+		print("%d frames, %d levels finished, %.1f frames per second" %
+			  (num_frames,levels,num_frames/elapsed))
+		return
+	if replay_file != None:
+		with open(replay_file) as f:
+			session = json.load(f)
+		obj = Game(LEVEL_INFOS[session["level_info"]],bHeadless=True)
+		if profile_file != None:
+			obj.profiler.log = open(profile_file,"a")
+		start = time.perf_counter()
+		num_frames, mismatches = obj.Replay(session)
+		elapsed = time.perf_counter()-start
+		print("%d frames, %d levels replayed, %d mismatched, %.1f frames per second" %
+			  (num_frames,len(session["levels"]),len(mismatches),num_frames/max(elapsed,1e-9)))
+		if len(mismatches) > 0:
+			print("Levels that came out differently: %s" % " ".join([ str(l) for l in mismatches ]))
+			sys.exit(2)
+		return
+	obj = Game(level_info,start_level=start_level,bDirtyRects=bDirtyRects)
+	if profile_file != None:
+		obj.profiler.log = open(profile_file,"a")
+	if record_file != None:
+		obj.recorder = SessionRecorder(obj)
 	obj.Run()
+	if record_file != None:
+		obj.recorder.Save(record_file)
 	
 if __name__=="__main__":
+	#A frozen build would otherwise start the whole game again as its
+	#level worker
+	multiprocessing.freeze_support()
 	main()
\ No newline at end of file
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+## Copyright (c) 2023, Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+## 1. Redistributions of source code must retain the above copyright notice, this
+##    list of conditions and the following disclaimer.
+##
+## 2. Redistributions in binary form must reproduce the above copyright notice,
+##    this list of conditions and the following disclaimer in the documentation
+##    and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+## DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+## SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+## CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+## OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+## OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import gc
+import os
+import sys
+import json
+import time
+import random
+import platform
+
+#The game loads everything relative to its own directory
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import pygame
+import scooby_maze
+
+LEVEL_SWEEP       = [1, 25, 100, 400]
+QUICK_LEVEL_SWEEP = [1, 25]
+LEVEL_INFOS = [ ("default",scooby_maze._default_level_info),
+				("parent",scooby_maze.parent_level_info) ]
+REGRESSION_THRESHOLD = 1.25
+#Every timed sample calls the benchmark enough times to take at least
+#this long, so short benchmarks are not lost in timer noise
+MIN_SAMPLE_SECONDS = 0.1
+#Levels are seeded from the game's seed, so every run times the same ones
+BENCH_SEED = 1
+
+def time_calls(func,loops):
+	#Garbage collection is held off while timing, like timeit does
+	gc.collect()
+	gc.disable()
+	try:
+		start = time.perf_counter()
+		for i in range(loops):
+			func()
+		return time.perf_counter()-start
+	finally:
+		gc.enable()
+
+def best_of(repeats,func):
+	#Return the fastest wall clock time of one call of func.  After an
+	#untimed call to warm up caches, the number of calls per sample is
+	#raised (1, 2, 5, 10, 20, ...) until a sample takes at least
+	#MIN_SAMPLE_SECONDS, and then the best of repeats samples is kept.
+	random.seed(0)
+	func()
+	loops = 1
+	scale = 0
+	while time_calls(func,loops) < MIN_SAMPLE_SECONDS:
+		loops = [2,5,10][scale%3]*(10**int(scale/3))
+		scale = scale+1
+	best = None
+	for i in range(repeats):
+		random.seed(i)
+		elapsed = time_calls(func,loops)/float(loops)
+		if best == None or elapsed < best:
+			best = elapsed
+	return best
+
+def generate_level(game):
+	#Build the game's current level as if it were the first attempt at
+	#it, so every repeat gets the same maze, ghosts and play
+	game.level_attempts.clear()
+	game._GenerateLevel()
+
+def result(name,mode,level,ops,seconds,**extra):
+	record = { "name"    : name,
+			   "mode"    : mode,
+			   "level"   : level,
+			   "ops"     : ops,
+			   "seconds" : seconds,
+			   "per_op"  : seconds/float(ops) }
+	record.update(extra)
+	return record
+
+def bench_level(game,mode,level_info,level,repeats):
+	results = []
+	maze_width, maze_height, num_ghosts, shaggy_speed, ghost_speed, scooby_speed = level_info(level)
+	cell_width  = game.max_sprite_width+(2*shaggy_speed)
+	cell_height = game.max_sprite_height+(2*shaggy_speed)
+	cells = maze_width*maze_height
+
+	#Maze generation
+	seconds = best_of(repeats,lambda: scooby_maze.Maze(maze_width,maze_height,
+													   cell_width,cell_height,10,
+													   seed=BENCH_SEED))
+	results.append(result("maze_generate",mode,level,1,seconds,cells=cells))
+
+	#Build a real level to run the remaining benchmarks against
+	random.seed(0)
+	game.level = level
+	game.level_info = level_info
+	generate_level(game)
+	maze = game.maze
+	maze_rect = maze.GetMazeRect()
+	sprite_width, sprite_height = game.demo_ghost.GetMaxSize()
+
+	#Collision queries at random sprite sized rects
+	num_queries = 20000
+	random.seed(0)
+	rects = []
+	for i in range(num_queries):
+		rects.append(pygame.Rect(random.randint(0,maze_rect.width-sprite_width),
+								 random.randint(0,maze_rect.height-sprite_height),
+								 sprite_width,sprite_height))
+	def collide():
+		for rect in rects:
+			maze.Collide(rect)
+	seconds = best_of(repeats,collide)
+	results.append(result("maze_collide",mode,level,num_queries,seconds,cells=cells))
+
+	#Ghost movement, both straight Move calls and chasing Shaggy
+	ghosts = [ scooby_maze.MazeObject(demo=game.demo_ghost) for ghost in game.ghosts ]
+	start_positions = [ game.ghosts.GetMazeRect(ghost).topleft for ghost in game.ghosts ]
+	num_steps = max(1,int(2000/max(1,len(ghosts))))
+	def reset():
+		for ghost, pos in zip(ghosts,start_positions):
+			ghost.SetPosition(*pos)
+	def move():
+		reset()
+		for i in range(num_steps):
+			x_offset = random.randint(-ghost_speed,ghost_speed)
+			y_offset = random.randint(-ghost_speed,ghost_speed)
+			for ghost in ghosts:
+				ghost.Move(maze,x_offset,y_offset)
+	def attack():
+		reset()
+		for i in range(num_steps):
+			for ghost in ghosts:
+				ghost.Attack(maze,game.shaggy,ghost_speed)
+	ops = num_steps*max(1,len(ghosts))
+	results.append(result("object_move",mode,level,ops,best_of(repeats,move),
+						  ghosts=len(ghosts)))
+	results.append(result("object_attack",mode,level,ops,best_of(repeats,attack),
+						  ghosts=len(ghosts)))
+
+	#Drawing the maze, first with an empty tile cache and then warm
+	screen = game.screen
+	num_views = 50
+	random.seed(0)
+	views = []
+	for i in range(num_views):
+		view = pygame.Rect(game.view_rect)
+		view.left = random.randint(0,max(0,maze_rect.width-view.width))
+		view.top = random.randint(0,max(0,maze_rect.height-view.height))
+		views.append(view)
+	def draw():
+		for view in views:
+			maze.Draw(screen,view)
+	def draw_cold():
+		maze.tiles.clear()
+		draw()
+	results.append(result("maze_draw_cold",mode,level,num_views,
+						  best_of(repeats,draw_cold),cells=cells))
+	results.append(result("maze_draw_warm",mode,level,num_views,
+						  best_of(repeats,draw),cells=cells))
+
+	#Full frames: game logic plus rendering.  Level generation when a
+	#level ends is left out of the timing.  Each sample plays at least
+	#num_frames frames and MIN_SAMPLE_SECONDS, and the first one only
+	#warms up.
+	num_frames = 30
+	best = None
+	for i in range(repeats+1):
+		random.seed(i)
+		generate_level(game)
+		seconds = 0.0
+		frames = 0
+		while frames < num_frames or seconds < MIN_SAMPLE_SECONDS:
+			game.clock.tick()
+			start = time.perf_counter()
+			state = game._RunFrame()
+			game._DrawFrame()
+			seconds = seconds + time.perf_counter()-start
+			frames = frames + 1
+			if state != game.PLAYING:
+				game._GenerateLevel()
+		if i > 0 and (best == None or seconds/frames < best):
+			best = seconds/frames
+	results.append(result("run_frame",mode,level,1,best,
+						  ghosts=num_ghosts,cells=cells))
+	return results
+
+def run(levels,repeats):
+	game = scooby_maze.Game(bHeadless=True,seed=BENCH_SEED)
+	#Nothing else may be running while benchmarks are timed
+	game.sound_thread.join()
+	results = []
+	for mode, level_info in LEVEL_INFOS:
+		for level in levels:
+			results.extend(bench_level(game,mode,level_info,level,repeats))
+	return { "python"  : platform.python_version(),
+			 "pygame"  : pygame.version.ver,
+			 "machine" : platform.machine(),
+			 "results" : results }
+
+def compare(report,baseline,threshold):
+	#Print the ratio of every result to its baseline and return the
+	#names of the ones that got slower than the threshold allows
+	old = {}
+	for record in baseline["results"]:
+		old[(record["name"],record["mode"],record["level"])] = record
+	regressions = []
+	for record in report["results"]:
+		key = (record["name"],record["mode"],record["level"])
+		if key not in old:
+			continue
+		ratio = record["per_op"]/old[key]["per_op"]
+		record["baseline_ratio"] = ratio
+		flag = ""
+		if ratio > threshold:
+			flag = "  REGRESSION"
+			regressions.append("%s/%s/%d" % key)
+		sys.stderr.write("%-16s %-8s level %-4d %8.2fx%s\n" % (key+(ratio,flag)))
+	return regressions
+
+def usage():
+	print("Usage:")
+	print("   scooby_maze_bench.py [-h] [-q] [-r repeats] [-o output] [-b baseline] [-t threshold]")
+	print("")
+	print("h - Show this message")
+	print("q - Quick run over a smaller sweep of levels")
+	print("r - Number of times each benchmark is repeated (best is kept)")
+	print("o - Write the JSON report to a file instead of stdout")
+	print("b - Compare against a previously saved JSON report")
+	print("t - Slowdown ratio counted as a regression (default %.2f)" % REGRESSION_THRESHOLD)
+	sys.exit(1)
+
+def main():
+	levels = LEVEL_SWEEP
+	repeats = 3
+	output = None
+	baseline = None
+	threshold = REGRESSION_THRESHOLD
+	i = 1
+	while i < len(sys.argv):
+		if sys.argv[i] == "-h":
+			usage()
+		elif sys.argv[i] == "-q":
+			levels = QUICK_LEVEL_SWEEP
+		elif sys.argv[i] in ["-r","-o","-b","-t"] and len(sys.argv) > i+1:
+			try:
+				if sys.argv[i] == "-r":
+					repeats = int(sys.argv[i+1])
+				elif sys.argv[i] == "-o":
+					output = sys.argv[i+1]
+				elif sys.argv[i] == "-b":
+					baseline = sys.argv[i+1]
+				else:
+					threshold = float(sys.argv[i+1])
+			except Exception:
+				usage()
+			else:
+				i = i + 1
+		else:
+			usage()
+		i = i + 1
+
+	report = run(levels,repeats)
+	regressions = []
+	if baseline != None:
+		with open(baseline) as f:
+			regressions = compare(report,json.load(f),threshold)
+		report["regressions"] = regressions
+
+	text = json.dumps(report,indent=1)
+	if output != None:
+		with open(output,"w") as f:
+			f.write(text+"\n")
+	else:
+		print(text)
+	if len(regressions) > 0:
+		sys.exit(2)
+
+if __name__=="__main__":
+	main()